@@ -21,6 +21,7 @@ sys.path.insert(0, QUACLIB)
 
 import forecast
 import timeseries
+import topk
 import u
 
 ### Globals ###
@@ -143,7 +144,7 @@ def main():
    # 2a. Find top candidates within each shard for each context
    #
    #     key: Context
-   #     val: Priority_Queue:
+   #     val: Top_K:
    #             pri:  r [correlation with ground truth on training data]
    #             val:  (Series [complete time series, .name is URL],
    #                    Series [shifted/truncated training data, .name is URL])
@@ -272,7 +273,7 @@ def candidates_merge(pq_a, pq_b):
 
 def candidates_read(worker_i):
    start = time.time()
-   cands = [(ctx, u.Priority_Queue(args_b.value.candidates))
+   cands = [(ctx, topk.Top_K(args_b.value.candidates))
             for ctx in tests_b.value]
    for (i, full) in enumerate(input_read(worker_i)):
       if (i >= args_b.value.limit):
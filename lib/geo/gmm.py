@@ -706,7 +706,9 @@ class Geo_GMM(base.Location_Estimate, sklearn.mixture.GMM):
       if (identity):
          od['%s/%d' % (self.__class__.__name__, id(self))] = 1
       if (misc):
-         od.update({ t[:2]:1 for t in self.tokens.keys() })  # tweet field
+         # tweet field (not recoverable from hashed tokens)
+         od.update({ t[:2]:1 for t in self.tokens.keys()
+                     if isinstance(t, str) })
          od['one'] = 1
          od['n_components'] = self.n_components
          od['n_points'] = self.n_points
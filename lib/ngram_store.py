@@ -0,0 +1,402 @@
+'''Indexed, memory-mapped store of n-gram time series.
+
+   The output of ``ngrams-build`` is a set of partitions, each a sorted text
+   file of base64-encoded pickles; finding one n-gram means hashing it to a
+   partition and then decoding that partition line by line until the key
+   matches. This module converts that output into a store which can be
+   searched in O(log n) without reading or decoding anything else:
+
+     keys    UTF-8 n-grams, concatenated in sorted (byte) order
+     index   one fixed-size record per n-gram, in the same order, giving the
+             location of the key and of its series plus the series' first day
+             and the n-gram's total (see INDEX_DTYPE)
+     series  the daily counts of all n-grams, concatenated, as float32
+
+   All three files are memory-mapped, so opening a store is cheap regardless
+   of its size and lookups touch only the pages they need. Because keys are
+   sorted, prefix queries and batches of queries are also cheap.
+
+   The module also provides a *vocabulary* (:class:`Vocab`), which maps
+   n-grams to small integer ids, for ``ngrams-build --vocab``.
+
+   For example:
+
+   >>> import tempfile
+   >>> tmp = tempfile.mkdtemp()
+   >>> dv = math_.Date_Vector
+   >>> w = Writer(tmp + '/idx')
+   >>> for k in ('t@ a', 't@ ab', 't@ b', 't@ café'):
+   ...    w.add(k, { 'ngram': k, 'total': len(k),
+   ...               'series': dv('2013-06-02',
+   ...                            np.arange(len(k), dtype=np.float32)) })
+   >>> w.add('t@ aa', None)
+   Traceback (most recent call last):
+     ...
+   ValueError: keys out of order: 't@ aa' after 't@ café'
+   >>> w.close()
+   >>> r = Reader(tmp + '/idx')
+   >>> len(r)
+   4
+   >>> v = r.get('t@ café')
+   >>> (v['ngram'], v['total'], v['series'].first_day)
+   ('t@ café', 7, datetime.date(2013, 6, 2))
+   >>> v['series'].tolist()
+   [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+   >>> r.get('t@ c')
+   Traceback (most recent call last):
+     ...
+   KeyError: 't@ c'
+   >>> [k for (k, v) in r.prefix('t@ a')]
+   ['t@ a', 't@ ab']
+   >>> [k for (k, v) in r.get_many(['t@ b', 'nope', 't@ a'])]
+   ['t@ a', 't@ b']
+   >>> [k for (k, v) in r]
+   ['t@ a', 't@ ab', 't@ b', 't@ café']'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import datetime
+import hashlib
+import heapq
+import io
+import operator
+import os
+import shutil
+
+import numpy as np
+
+import math_
+import qr.base
+import testable
+import u
+
+
+# Layout of one index record. key and series are offsets (in bytes and in
+# elements respectively) into the keys and series files.
+INDEX_DTYPE = np.dtype([('key', '<u8'),
+                        ('key_len', '<u4'),
+                        ('first_day', '<i4'),
+                        ('series', '<u8'),
+                        ('series_len', '<u4'),
+                        ('total', '<i8')])
+
+# Number of index records to buffer before writing.
+INDEX_BUFSIZE = 65536
+
+# Format of vocabulary ids used as QUACreduce keys. Zero-padding makes the
+# byte order of the keys the numeric order of the ids, which is also the
+# byte order of the n-grams.
+ID_KEY_FMT = '%010d'
+
+# Largest vocabulary (ids are uint32).
+VOCAB_MAX = 2**32 - 1
+
+
+class Reader(object):
+
+   def __init__(self, dir_):
+      self.dir_ = dir_
+      self.keys = map_(dir_, 'keys', np.uint8)
+      self.index = map_(dir_, 'index', INDEX_DTYPE)
+      self.series = map_(dir_, 'series', np.float32)
+
+   def __iter__(self):
+      for i in range(len(self)):
+         yield self.item(i)
+
+   def __len__(self):
+      return len(self.index)
+
+   def bisect(self, key, lo=0):
+      '''Return the index of the first key not less than bytes key, searching
+         from lo.'''
+      hi = len(self)
+      while (lo < hi):
+         mid = (lo + hi) // 2
+         if (self.key_bytes(mid) < key):
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def get(self, key):
+      '''Return the value (as written by ngrams-build) of n-gram key, or raise
+         KeyError if it's not in the store.'''
+      kb = key.encode('utf8')
+      i = self.bisect(kb)
+      if (i >= len(self) or self.key_bytes(i) != kb):
+         raise KeyError(key)
+      return self.item(i)[1]
+
+   def get_many(self, keys):
+      '''Yield (key, value) pairs for each of keys in the store, in sorted
+         order. Each search starts where the last one stopped, so this is
+         faster than calling get() repeatedly.'''
+      i = 0
+      for kb in sorted(set(k.encode('utf8') for k in keys)):
+         i = self.bisect(kb, i)
+         if (i >= len(self)):
+            break
+         if (self.key_bytes(i) == kb):
+            yield self.item(i)
+
+   def item(self, i):
+      'Return the (key, value) pair at index i.'
+      rec = self.index[i]
+      key = self.key_bytes(i).decode('utf8')
+      start = int(rec['series'])
+      series = math_.Date_Vector(
+         datetime.date.fromordinal(int(rec['first_day'])),
+         np.array(self.series[start:start + int(rec['series_len'])]))
+      return (key, { 'ngram': key,
+                     'total': int(rec['total']),
+                     'series': series })
+
+   def key_bytes(self, i):
+      rec = self.index[i]
+      start = int(rec['key'])
+      return self.keys[start:start + int(rec['key_len'])].tobytes()
+
+   def prefix(self, prefix):
+      'Yield (key, value) pairs for keys starting with prefix, in order.'
+      pb = prefix.encode('utf8')
+      i = self.bisect(pb)
+      while (i < len(self) and self.key_bytes(i).startswith(pb)):
+         yield self.item(i)
+         i += 1
+
+
+class Vocab(object):
+
+   '''Vocabulary of n-grams, each with an id: its position in byte order.
+      Files, all memory-mapped, are:
+
+        keys         UTF-8 n-grams, concatenated in order
+        key_offsets  offset of each n-gram in keys, plus the total length
+                     (uint64)
+        hashes       64-bit hash of each n-gram (see key_hash()), sorted
+        hash_ids     id of the n-gram with each hash (uint32)
+
+      Finding ids by hash lets a mapper look up all the n-grams in a tweet
+      with one vectorized search. For example:
+
+      >>> import tempfile
+      >>> tmp = tempfile.mkdtemp()
+      >>> w = Vocab_Writer(tmp + '/v')
+      >>> cafe = 't@ café'.encode('utf8')
+      >>> for k in (b't@ a', b't@ b', cafe):
+      ...    w.add(k)
+      >>> w.close()
+      >>> v = Vocab(tmp + '/v')
+      >>> len(v)
+      3
+      >>> v.ids_of([cafe, b'nope', b't@ a', b't@ a'])
+      array([ 2, -1,  0,  0])
+      >>> v.key_of(2)
+      't@ café'
+      >>> v.ids_of([])
+      array([], dtype=int64)'''
+
+   def __init__(self, dir_):
+      self.dir_ = dir_
+      self.keys = map_(dir_, 'keys', np.uint8)
+      self.key_offsets = map_(dir_, 'key_offsets', np.uint64)
+      self.hashes = map_(dir_, 'hashes', np.uint64)
+      self.hash_ids = map_(dir_, 'hash_ids', np.uint32)
+
+   def __len__(self):
+      return len(self.hashes)
+
+   def ids_of(self, keys):
+      '''Return an array of the ids of bytes objects keys, with -1 for those
+         not in the vocabulary.'''
+      ids = np.full(len(keys), -1, dtype=np.int64)
+      if (len(keys) == 0 or len(self) == 0):
+         return ids
+      hashes = np.fromiter((key_hash(k) for k in keys), dtype=np.uint64,
+                           count=len(keys))
+      for (i, p) in enumerate(np.searchsorted(self.hashes, hashes).tolist()):
+         # Hashes can collide, so check the key too.
+         while (p < len(self) and self.hashes[p] == hashes[i]):
+            id_ = int(self.hash_ids[p])
+            if (self.key_bytes(id_) == keys[i]):
+               ids[i] = id_
+               break
+            p += 1
+      return ids
+
+   def key_bytes(self, id_):
+      return self.keys[int(self.key_offsets[id_]):
+                       int(self.key_offsets[id_ + 1])].tobytes()
+
+   def key_of(self, id_):
+      'Return the n-gram with id id_.'
+      return self.key_bytes(id_).decode('utf8')
+
+
+class Vocab_Writer(object):
+
+   '''Write a vocabulary to directory dir_. As with :class:`Writer`, keys
+      (bytes) must be added in increasing order, and the vocabulary is moved
+      into place by close().'''
+
+   def __init__(self, dir_):
+      self.dir_ = dir_
+      self.tmp = dir_ + '.tmp'
+      shutil.rmtree(self.tmp, ignore_errors=True)
+      os.makedirs(self.tmp)
+      self.keys_fp = io.open(self.tmp + '/keys', 'wb')
+      self.key_offsets_fp = io.open(self.tmp + '/key_offsets', 'wb')
+      self.hashes_fp = io.open(self.tmp + '/hashes.unsorted', 'wb')
+      self.key_last = None
+      self.key_ct = 0
+      self.key_offset = 0
+
+   def add(self, key):
+      if (self.key_last is not None and key <= self.key_last):
+         raise ValueError('keys out of order: %r after %r'
+                          % (key, self.key_last))
+      if (self.key_ct >= VOCAB_MAX):
+         raise ValueError('too many keys for vocabulary')
+      self.keys_fp.write(key)
+      self.key_offsets_fp.write(np.uint64(self.key_offset).tobytes())
+      self.hashes_fp.write(np.uint64(key_hash(key)).tobytes())
+      self.key_last = key
+      self.key_ct += 1
+      self.key_offset += len(key)
+
+   def close(self):
+      self.key_offsets_fp.write(np.uint64(self.key_offset).tobytes())
+      for fp in (self.keys_fp, self.key_offsets_fp, self.hashes_fp):
+         fp.close()
+      hashes = np.fromfile(self.tmp + '/hashes.unsorted', dtype=np.uint64)
+      ids = np.argsort(hashes, kind='stable')
+      hashes[ids].tofile(self.tmp + '/hashes')
+      ids.astype(np.uint32).tofile(self.tmp + '/hash_ids')
+      os.unlink(self.tmp + '/hashes.unsorted')
+      shutil.rmtree(self.dir_, ignore_errors=True)
+      os.rename(self.tmp, self.dir_)
+
+
+class Writer(object):
+
+   '''Write a store to directory dir_. Keys must be added in increasing byte
+      order, which is the order of QUACreduce's sorted output. The store is
+      assembled in dir_.tmp and moved into place by close(), replacing any
+      existing store.'''
+
+   def __init__(self, dir_):
+      self.dir_ = dir_
+      self.tmp = dir_ + '.tmp'
+      shutil.rmtree(self.tmp, ignore_errors=True)
+      os.makedirs(self.tmp)
+      self.keys_fp = io.open(self.tmp + '/keys', 'wb')
+      self.index_fp = io.open(self.tmp + '/index', 'wb')
+      self.series_fp = io.open(self.tmp + '/series', 'wb')
+      self.index_buf = list()
+      self.key_last = None
+      self.key_ct = 0
+      self.key_offset = 0
+      self.series_offset = 0
+
+   def add(self, key, value):
+      kb = key.encode('utf8')
+      if (self.key_last is not None and kb <= self.key_last):
+         raise ValueError('keys out of order: %r after %r'
+                          % (key, self.key_last.decode('utf8')))
+      series = np.asarray(value['series'], dtype=np.float32)
+      self.keys_fp.write(kb)
+      self.series_fp.write(series.tobytes())
+      self.index_buf.append((self.key_offset, len(kb),
+                             value['series'].first_day.toordinal(),
+                             self.series_offset, len(series),
+                             value['total']))
+      if (len(self.index_buf) >= INDEX_BUFSIZE):
+         self.index_flush()
+      self.key_last = kb
+      self.key_ct += 1
+      self.key_offset += len(kb)
+      self.series_offset += len(series)
+
+   def close(self):
+      self.index_flush()
+      for fp in (self.keys_fp, self.index_fp, self.series_fp):
+         fp.close()
+      shutil.rmtree(self.dir_, ignore_errors=True)
+      os.rename(self.tmp, self.dir_)
+
+   def index_flush(self):
+      self.index_fp.write(np.array(self.index_buf, dtype=INDEX_DTYPE)
+                          .tobytes())
+      self.index_buf = list()
+
+
+def build(inputdir, dir_):
+   '''Build a store in dir_ from the numbered partitions in inputdir (i.e.,
+      ngrams-build output), and return the number of n-grams. Each partition
+      is sorted, so they are merged rather than sorted again. E.g.:
+
+      >>> import tempfile
+      >>> tmp = tempfile.mkdtemp()
+      >>> def part(name, *keys):
+      ...    with io.open('%s/%s' % (tmp, name), 'wb') as fp:
+      ...       for k in keys:
+      ...          v = { 'ngram': k, 'total': 1,
+      ...                'series': math_.Date_Vector('2013-06-02',
+      ...                                            np.ones(1)) }
+      ...          fp.write(('%s\\t' % (k)).encode('utf8')
+      ...                   + qr.base.encode(v) + b'\\n')
+      >>> part('0', 'a', 'c')
+      >>> part('1', 'b')
+      >>> part('2')
+      >>> part('total.pkl.gz')
+      >>> build(tmp, tmp + '/index')
+      3
+      >>> [k for (k, v) in Reader(tmp + '/index')]
+      ['a', 'b', 'c']'''
+   w = Writer(dir_)
+   for (k, v) in partitions_merge(inputdir):
+      w.add(k.decode('utf8'), qr.base.decode(v))
+   w.close()
+   return w.key_ct
+
+def key_hash(key):
+   '''Return the 64-bit hash of bytes key used by :class:`Vocab`. E.g.:
+
+      >>> key_hash(b't@ a')
+      9704966270934777280'''
+   return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(),
+                         'little')
+
+def map_(dir_, name, dtype):
+   'Return file name in directory dir_ memory-mapped as an array of dtype.'
+   path = '%s/%s' % (dir_, name)
+   if (os.path.getsize(path) == 0):
+      return np.zeros(0, dtype=dtype)  # can't mmap an empty file
+   return np.memmap(path, dtype=dtype, mode='r')
+
+def partitions_merge(inputdir):
+   '''Yield (key, value) pairs, both bytes, from the sorted numbered
+      partitions in inputdir, in key order.'''
+   def kvs(i):
+      with io.open('%s/%d' % (inputdir, i), 'rb') as fp:
+         for line in fp:
+            (k, _, v) = line.partition(b'\t')
+            yield (k, v)
+   file_ct = (u.glob_maxnumeric(inputdir) or 0) + 1
+   return heapq.merge(*[kvs(i) for i in range(file_ct)],
+                      key=operator.itemgetter(0))
+
+def vocab_build(inputdir, dir_):
+   '''Build a vocabulary in dir_ from the keys of the numbered partitions in
+      inputdir (i.e., the output of ``ngrams-build --vocab``'s first pass),
+      and return its size.'''
+   w = Vocab_Writer(dir_)
+   for (k, _) in partitions_merge(inputdir):
+      w.add(k)
+   w.close()
+   return w.key_ct
+
+
+testable.register('')
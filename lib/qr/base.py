@@ -36,30 +36,111 @@
 
 from abc import ABCMeta, abstractmethod
 import base64
+import collections
+import gzip
 import pickle as pickle
 import io
 import itertools
+import json
 import operator
+import os
+import shutil
+import socket
 import sys
+import tempfile
+import time
 
 import testable
 import tsv_glue
 import u
+from . import skew
+from . import sort
 
 
 # We use a relatively large output buffer size; see also OUTPUT_BUFSIZE in
 # hashsplit.c.)
 OUTPUT_BUFSIZE = 4194304
 
+# Default number of values a combining mapper holds in memory before flushing
+# its partial aggregates; see Combine_Job. This is a proxy for memory use,
+# which is expensive to measure on every write.
+COMBINE_LIMIT = 1048576
+
+# Number of records between samples of memory use for the task statistics;
+# must be a power of two.
+STATS_RSS_INTERVAL = 65536
+
+# Default number of bytes of encoded values per key that Bounded_Reduce_Job
+# holds in memory before spilling to disk.
+REDUCE_BUFFER_LIMIT = 67108864
+
+# Number of keys whose partition Partition_Output_Job remembers. Hashing in
+# Python is slow, and map output keys tend to repeat.
+PARTITION_CACHE_MAX = 1048576
+
 
 ### Helper functions ###
 
+def count(values):
+   '''Return the number of items in iterable values without keeping them.
+      E.g.:
+
+      >>> count(i for i in range(5))
+      5'''
+   ct = 0
+   for _ in values:
+      ct += 1
+   return ct
+
 def decode(bytes_):
    return pickle.loads(base64.b64decode(bytes_))
 
 def encode(value):
    return base64.b64encode(pickle.dumps(value, -1))
 
+def partition_open(basename, nparts, compress=False):
+   '''Create directory basename and return a list of nparts files
+      basename/0, basename/1, etc., open for writing map output in the same
+      format as ``hashsplit`` (gzipped, like ``hashsplit -z``, if
+      compress).'''
+   u.mkdir_f(basename)
+   if (compress):
+      return [gzip.open('%s/%d' % (basename, i), 'wb',
+                        compresslevel=sort.SPILL_COMPRESSLEVEL)
+              for i in range(nparts)]
+   else:
+      return [io.open('%s/%d' % (basename, i), 'wb', buffering=OUTPUT_BUFSIZE)
+              for i in range(nparts)]
+
+def sum_by(pairs):
+   '''Given an iterable of (subkey, number) pairs, return a Counter with the
+      total for each subkey. Memory use depends only on the number of
+      distinct subkeys, not the number of pairs. E.g.:
+
+      >>> sorted(sum_by([('a', 1), ('b', 2), ('a', 3)]).items())
+      [('a', 4), ('b', 2)]'''
+   totals = collections.Counter()
+   for (subkey, number) in pairs:
+      totals[subkey] += number
+   return totals
+
+def vector_sum(vectors):
+   '''Return the elementwise sum of iterable vectors, which must be numpy
+      arrays of the same shape (or other objects with copy() and +=), or
+      None if there are none. Only the running total is kept. E.g.:
+
+      >>> import numpy as np
+      >>> vector_sum(np.array([i, 1]) for i in range(4))
+      array([6, 4])
+      >>> vector_sum([]) is None
+      True'''
+   total = None
+   for v in vectors:
+      if (total is None):
+         total = v.copy()
+      else:
+         total += v
+   return total
 
 
 ### Classes ###
@@ -83,6 +164,8 @@ class Job(object, metaclass=ABCMeta):
          else:
             self.params = params
       self.rid = None
+      self.task = None
+      self.stats_init()
       # Yes, you can quac() instead of map() ...
       self.quac = self.map
 
@@ -125,17 +208,39 @@ class Job(object, metaclass=ABCMeta):
    def map_open_output(self):
       self.outfp = io.open(sys.stdout.fileno(), 'wb')
 
-   def map_stdinout(self):
-      '''Connect myself to input and output and run my mapper.'''
-      #p = u.Profiler()
+   def map_stdinout(self, ibase=None):
+      '''Connect myself to input and output and run my mapper. If ibase (the
+         basename of the input file) is given, save task statistics.'''
+      if (ibase):
+         self.task = 'map-%s' % (ibase)
       self.map_open_input()
       self.map_open_output()
+      self.map_run()
+
+   def map_run(self):
+      '''Run my mapper from the already-open ``self.infp`` to the already-open
+         ``self.outfp``. This is the part of :meth:`map_stdinout()` that
+         doesn't care where input and output go (see also :mod:`qr.local`).'''
+      #p = u.Profiler()
       self.map_init()
+      ct_in = 0
+      ct_out = 0
       for i in self.map_inputs():
+         ct_in += 1
+         if (ct_in & (STATS_RSS_INTERVAL - 1) == 0):
+            self.stats_rss()
          for kv in self.map(i):
+            ct_out += 1
             self.map_write(*kv)
+      self.map_flush()
       self.cleanup()
       #p.stop('map.prof')
+      self.stats_dump(ct_in, ct_out)
+
+   def map_flush(self):
+      '''Called after the last :meth:`map_write()`. Mixins that buffer map
+         output (e.g., :class:`Combine_Job`) write it out here.'''
+      pass
 
    def map_write(self, key, value):
       '''Write one key/value pair to the mapper output.'''
@@ -167,6 +272,11 @@ class Job(object, metaclass=ABCMeta):
    def reduce_open_input(self):
       self.infp = io.open(sys.stdin.fileno(), 'rb')
 
+   def reduce_value(self, line):
+      '''Return the value in reducer input line line (see
+         :meth:`reduce_inputs()`).'''
+      return decode(line.partition(b'\t')[2])
+
    def reduce_open_output(self):
       self.outfp = io.open(self.reduce_output_filename, 'wb',
                            buffering=OUTPUT_BUFSIZE)
@@ -177,16 +287,53 @@ class Job(object, metaclass=ABCMeta):
 
    def reduce_stdinout(self, rid):
       '''Connect myself to input and output, and run my reducer.'''
-      #p = u.Profiler()
       self.rid = rid
+      self.task = 'reduce-%d' % (rid)
       self.reduce_open_input()
       self.reduce_open_output()
+      self.reduce_run()
+
+   def reduce_sort(self, rid, filenames, sortdir, sortmem,
+                   fan_in=sort.FAN_IN, presorted=(), save=None,
+                   compressed=False):
+      '''Read map output from files filenames, sort it myself (see
+         :mod:`qr.sort`), and run my reducer. The other arguments are passed
+         to :func:`qr.sort.sorted_lines()`, except that sortmem is a string
+         in ``sort -S`` format. If save is given, also write the sorted input
+         to that file. The ``sort_time`` statistic includes the final merge,
+         which happens lazily as the reducer reads its input.'''
+      self.rid = rid
+      self.task = 'reduce-%d' % (rid)
+      self.spill_dir = sortdir
+      start = time.time()
+      self.infp = sort.sorted_lines(filenames, sortdir,
+                                    sort.size_parse(sortmem), fan_in,
+                                    presorted, compressed)
+      self.stats['sort_time'] = time.time() - start
+      self.infp = sort.timed(self.infp, self.stats, 'sort_time')
+      if (save is not None):
+         self.infp = sort.tee(self.infp, save)
+      self.reduce_open_output()
+      self.reduce_run()
+
+   def reduce_run(self):
+      '''Run my reducer from the already-open ``self.infp``, which must be
+         sorted by key, to the already-open ``self.outfp``. :attr:`rid` must
+         be set.'''
+      #p = u.Profiler()
       self.reduce_init()
+      ct_in = 0
+      ct_out = 0
       for kvals in self.reduce_inputs():
+         ct_in += 1
+         if (ct_in & (STATS_RSS_INTERVAL - 1) == 0):
+            self.stats_rss()
          for item in self.reduce(*kvals):
+            ct_out += 1
             self.reduce_write(item)
       self.cleanup()
       #p.stop('reduce.prof')
+      self.stats_dump(ct_in, ct_out)
 
    @abstractmethod
    def reduce_write(self, item):
@@ -195,6 +342,134 @@ class Job(object, metaclass=ABCMeta):
          (e.g. :class:`Line_Output`).'''
       pass
 
+   def stats_dump(self, records_in, records_out):
+      '''Finish my task statistics, given the number of input and output
+         records (for reducers, input records are keys), and if I have a task
+         name and am in a job directory, write them to
+         ``tmp/stats/<task>.json`` (see :mod:`qr.report`). Times are in
+         seconds and memory in bytes.'''
+      if (not self.task or not os.path.isdir('tmp')):
+         return
+      self.stats_rss()
+      times = os.times()
+      self.stats.update({ 'task': self.task,
+                          'host': socket.gethostname(),
+                          'pid': os.getpid(),
+                          'wall': time.time() - self.stats['start'],
+                          'cpu_user': times[0] - self.stats_times[0],
+                          'cpu_sys': times[1] - self.stats_times[1],
+                          'records_in': records_in,
+                          'records_out': records_out })
+      os.makedirs('tmp/stats', exist_ok=True)
+      with io.open('tmp/stats/%s.json' % (self.task), 'wt') as fp:
+         json.dump(self.stats, fp, sort_keys=True, indent=1)
+
+   def stats_init(self):
+      'Start collecting task statistics.'
+      self.stats = { 'start': time.time(),
+                     'rss_peak': 0,
+                     'sort_time': None }
+      self.stats_times = os.times()
+
+   def stats_rss(self):
+      'Update peak memory use in my task statistics.'
+      self.stats['rss_peak'] = max(self.stats['rss_peak'], u.memory_use()[1])
+
+
+class Bounded_Reduce_Job(Job):
+
+   '''Mixin which hands :meth:`reduce()` its values as a
+      :class:`Reduce_Values` object rather than a one-shot iterator. This
+      can be iterated as many times as needed and has a length, so reducers
+      need not build a list of the values, which for a very common key can
+      exhaust memory. At most :attr:`reduce_buffer_limit` bytes of encoded
+      values per key are kept in memory; beyond that, the key's values are
+      spilled to a temporary file in :attr:`spill_dir` (``--sortdir`` if the
+      reducer sorts its own input, otherwise the system default) and read
+      back from there. The limit can be overridden with the job parameter
+      ``reduce_buffer_limit``.
+
+      Reducers which merely total their values should instead consume the
+      iterator once with a streaming helper such as :func:`sum_by()` or
+      :func:`vector_sum()`, which need no spilling at all.'''
+
+   reduce_buffer_limit = REDUCE_BUFFER_LIMIT
+   spill_dir = None
+
+   def reduce_init(self):
+      super(Bounded_Reduce_Job, self).reduce_init()
+      if (self.params is not None and 'reduce_buffer_limit' in self.params):
+         self.reduce_buffer_limit = self.params['reduce_buffer_limit']
+      self.spill_ct = 0
+      self.decode_skip_ct = 0
+
+   def reduce_inputs(self):
+      keyed = ((l.partition(b'\t')[0], l) for l in self.infp)
+      for (key, grp) in itertools.groupby(keyed, key=operator.itemgetter(0)):
+         try:
+            key = key.decode('utf8')
+         except UnicodeDecodeError:
+            # ignore Unicode problems, as in TSV_Internal_Job
+            self.decode_skip_ct += 1
+            continue
+         values = Reduce_Values((l for (_, l) in grp), self.reduce_value,
+                                self.reduce_buffer_limit, self.spill_dir)
+         if (values.spilled):
+            self.spill_ct += 1
+         yield (key, values)
+         values.close()
+      self.stats['spill_ct'] = self.spill_ct
+      self.stats['decode_skip_ct'] = self.decode_skip_ct
+
+
+class Combine_Job(Job):
+
+   '''Mixin which pre-aggregates map output before it leaves the mapper.
+      Subclasses implement :meth:`combine()`, which has the same signature as
+      :meth:`reduce()` but yields zero or more *values* for the same key
+      rather than arbitrary reduced items. The reducer then receives combined
+      values along with (or instead of) the raw ones, so :meth:`combine()` and
+      :meth:`reduce()` must agree on the value format, and :meth:`combine()`
+      must tolerate being applied to its own output.
+
+      Key/value pairs are buffered in a hash table keyed by key. When the
+      table holds more than :attr:`combine_limit` values, every key is
+      combined and written out, and the table is emptied; this bounds mapper
+      memory at the cost of some keys being emitted more than once. The limit
+      can be overridden with the job parameter ``combine_limit``.
+
+      This mixin must come before any mixin that implements
+      :meth:`map_write()` (e.g., :class:`TSV_Internal_Job`), since it passes
+      the combined pairs down to that method.'''
+
+   combine_limit = COMBINE_LIMIT
+
+   def map_init(self):
+      super(Combine_Job, self).map_init()
+      self.combine_buf = collections.defaultdict(list)
+      self.combine_ct = 0
+      if (self.params is not None and 'combine_limit' in self.params):
+         self.combine_limit = self.params['combine_limit']
+
+   @abstractmethod
+   def combine(self, key, values):
+      '''Generator which yields zero or more values that summarize the list
+         ``values``, all of which belong to ``key``.'''
+
+   def map_flush(self):
+      write = super(Combine_Job, self).map_write
+      for (key, values) in self.combine_buf.items():
+         for value in self.combine(key, values):
+            write(key, value)
+      self.combine_buf.clear()
+      self.combine_ct = 0
+
+   def map_write(self, key, value):
+      self.combine_buf[key].append(value)
+      self.combine_ct += 1
+      if (self.combine_ct > self.combine_limit):
+         self.map_flush()
+
 
 class Line_Input_Job(Job):
 
@@ -251,6 +526,122 @@ class KV_Pickle_Seq_Output_Job(Job):
       self.outfp.write(encode(item[1]))
       self.outfp.write(b'\n')
 
+class Partition_Output_Job(Job):
+
+   '''Mixin which partitions map output itself, writing each key/value pair
+      directly to the partition file for its key rather than to standard
+      output for ``hashsplit``. This saves a process and a pass over the map
+      output to find the keys again. The files and their contents are
+      exactly as ``hashsplit`` would write them, including ``-z`` and ``-m``
+      (see :func:`qr.skew.partition_of()`); :mod:`qr.scripting` and
+      :mod:`qr.local` notice this mixin and skip ``hashsplit``.
+
+      This mixin must come after any mixin that buffers map output (e.g.,
+      :class:`Combine_Job`) and before any that implements
+      :meth:`map_write()` (e.g., :class:`TSV_Internal_Job`).'''
+
+   partition_fps = None
+
+   def cleanup(self):
+      if (self.partition_fps is None):
+         # not mapping into partitions, e.g. reducing
+         super(Partition_Output_Job, self).cleanup()
+         return
+      self.partition_bytes = 0
+      for fp in self.partition_fps:
+         self.partition_bytes += fp.tell()
+         fp.close()
+      self.partition_fps = None
+
+   def map_partition(self, ibase, basename, nparts, compress=False,
+                     pmap_file=None):
+      '''Connect myself to standard input, run my mapper, and partition its
+         output into nparts files in directory basename, using the partition
+         map in file pmap_file if given. ibase is as in
+         :meth:`map_stdinout()`.'''
+      self.task = 'map-%s' % (ibase)
+      self.map_open_input()
+      self.partition_open(basename, nparts, compress,
+                          skew.map_read(pmap_file) if pmap_file else None)
+      self.map_run()
+
+   def map_write(self, key, value):
+      if (not isinstance(key, bytes)):
+         key_bytes = str(key).encode('utf8')
+      else:
+         key_bytes = key
+      try:
+         part = self.partition_cache[key_bytes]
+      except KeyError:
+         if (len(self.partition_cache) >= PARTITION_CACHE_MAX):
+            self.partition_cache.clear()
+         part = skew.partition_of(key_bytes, len(self.partition_fps),
+                                  self.partition_map)
+         self.partition_cache[key_bytes] = part
+      self.outfp = self.partition_fps[part]
+      super(Partition_Output_Job, self).map_write(key, value)
+
+   def partition_open(self, basename, nparts, compress=False, pmap=None):
+      '''Open the partition files (see :func:`partition_open()`) and use
+         partition map pmap, if given. After mapping, :attr:`partition_bytes`
+         is the number of bytes written (before compression).'''
+      self.partition_fps = partition_open(basename, nparts, compress)
+      self.partition_map = pmap if pmap is not None else dict()
+      self.partition_cache = dict()
+
+
+class Reduce_Values(object):
+
+   '''The values of one key in the reducer input, for
+      :class:`Bounded_Reduce_Job`. Reading all the input lines for the key,
+      from iterable lines, happens at construction; decoding (with function
+      decode) happens on each iteration. Lines are kept in memory until they
+      total more than limit bytes, after which all of them go to a temporary
+      file in directory dir_.'''
+
+   def __init__(self, lines, decode, limit, dir_=None):
+      self.decode = decode
+      self.lines = list()
+      self.spill = None
+      self.len = 0
+      bytes_ = 0
+      for line in lines:
+         self.len += 1
+         if (self.spill is not None):
+            self.spill.write(line)
+            continue
+         self.lines.append(line)
+         bytes_ += len(line)
+         if (bytes_ > limit):
+            self.spill = tempfile.NamedTemporaryFile(dir=dir_)
+            self.spill.writelines(self.lines)
+            self.lines = None
+
+   def __iter__(self):
+      if (self.spill is None):
+         for line in self.lines:
+            yield self.decode(line)
+      else:
+         # Open the file anew so that iterations don't interfere.
+         self.spill.flush()
+         with io.open(self.spill.name, 'rb') as fp:
+            for line in fp:
+               yield self.decode(line)
+
+   def __len__(self):
+      return self.len
+
+   @property
+   def spilled(self):
+      return (self.spill is not None)
+
+   def close(self):
+      'Discard the values (and spill file).'
+      if (self.spill is not None):
+         self.spill.close()
+      self.lines = None
+
+
 class Test_Job(Job):
    'Job with dummy implementations of all the abstract methods, for testing.'
    def map(self, item): pass
@@ -283,6 +674,9 @@ class TSV_Internal_Job(Job):
          self.outfp.write(v.encode('utf8'))
       self.outfp.write(b'\n')
 
+   def reduce_value(self, line):
+      return itertools.islice(line.split(b'\t'), 1, None)
+
    def reduce_inputs(self):
       for (key, values) in itertools.groupby((l.split(b'\t') for l in self.infp),
                                              key=operator.itemgetter(0)):
@@ -326,4 +720,95 @@ b'1\tgASVBgAAAAAAAABK/////y4=\n2\tgASVBgAAAAAAAABK/v///y4=\n2\tgASVBgAAAAAAAABK/
 >>> [(k, list(v)) for (k, v) in job.reduce_inputs()]
 [('1', [-1]), ('2', [-2, -3]), ('3', [-4, -5, -6])]
 
+# Test map-side combining: values for the same key are summed before they are
+# written, and the buffer is flushed when it grows past the limit.
+>>> class Sum_Job(Combine_Job, Test_Job):
+...    def combine(self, key, values):
+...       yield sum(values)
+>>> job = Sum_Job({ 'combine_limit': 4 })
+>>> job.outfp = io.BytesIO()
+>>> job.map_init()
+>>> for kv in [(1, 1), (2, 2), (1, 3), (2, 4), (1, 5), (3, 6)]:
+...    job.map_write(*kv)
+>>> job.map_flush()
+>>> job.outfp.seek(0)
+0
+>>> job.infp = job.outfp
+>>> [(k, list(v)) for (k, v) in job.reduce_inputs()]
+[('1', [9]), ('2', [6]), ('3', [6])]
+>>> job = Sum_Job({ 'combine_limit': 2 })
+>>> job.outfp = io.BytesIO()
+>>> job.map_init()
+>>> for kv in [(1, 1), (2, 2), (1, 3), (2, 4), (1, 5), (3, 6)]:
+...    job.map_write(*kv)
+>>> job.map_flush()
+>>> job.outfp.seek(0)
+0
+>>> job.infp = job.outfp
+>>> sorted((k, list(v)) for (k, v) in job.reduce_inputs())
+[('1', [4]), ('1', [5]), ('2', [2, 4]), ('3', [6])]
+
+# Test bounded reducing: values can be iterated more than once, whether they
+# fit in memory or not.
+>>> class Bounded_Job(Bounded_Reduce_Job, Test_Job): pass
+>>> job = Bounded_Job({ 'reduce_buffer_limit': 64 })
+>>> job.outfp = io.BytesIO()
+>>> for kv in [(1, 'x' * 10), (2, 'y')] + [(3, i) for i in range(10)]:
+...    job.map_write(*kv)
+>>> job.infp = io.BytesIO(job.outfp.getvalue())
+>>> job.reduce_init()
+>>> for (key, values) in job.reduce_inputs():
+...    print(key, len(values), values.spilled, list(values) == list(values))
+1 1 False True
+2 1 False True
+3 10 True True
+>>> job.stats['spill_ct']
+1
+
+# Keys which aren't UTF-8 are skipped and counted, as with TSV_Internal_Job.
+>>> job.infp = io.BytesIO(b'\xff\tgAVLAS4=\na\tgAVLAS4=\n')
+>>> job.reduce_init()
+>>> [(key, list(values)) for (key, values) in job.reduce_inputs()]
+[('a', [1])]
+>>> job.stats['decode_skip_ct']
+1
+
+# Test in-process partitioning: output is the same as hashsplit's (see also
+# qr.local.partition()), including after combining and with other
+# serializations.
+>>> import tempfile
+>>> tmp = tempfile.mkdtemp()
+>>> class Part_Job(Partition_Output_Job, Test_Job): pass
+>>> job = Part_Job()
+>>> job.partition_open(tmp + '/p', 240)
+>>> for kv in [('b', 1), ('nullvaluenotab', 2), ('b', 3)]:
+...    job.map_write(*kv)
+>>> job.cleanup()
+>>> job.partition_bytes
+46
+>>> def read(filename):
+...    job = Test_Job()
+...    job.infp = io.open(filename, 'rb')
+...    return [(k, list(v)) for (k, v) in job.reduce_inputs()]
+>>> read(tmp + '/p/37')
+[('b', [1, 3])]
+>>> read(tmp + '/p/145')
+[('nullvaluenotab', [2])]
+>>> class Sum_Part_Job(Combine_Job, Partition_Output_Job, TSV_Internal_Job,
+...                    Test_Job):
+...    def combine(self, key, values):
+...       yield (str(sum(int(v[0]) for v in values)),)
+>>> job = Sum_Part_Job()
+>>> job.partition_open(tmp + '/z', 240, compress=True, pmap={ b'q': 7 })
+>>> job.map_init()
+>>> for kv in [(b'b', ('1',)), (b'q', ('2',)), (b'b', ('3',))]:
+...    job.map_write(*kv)
+>>> job.map_flush()
+>>> job.cleanup()
+>>> gzip.open(tmp + '/z/37').read()
+b'b\t4\n'
+>>> gzip.open(tmp + '/z/7').read()
+b'q\t2\n'
+>>> shutil.rmtree(tmp)
+
 ''')
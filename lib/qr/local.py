@@ -0,0 +1,193 @@
+'''Run a Python QUACreduce job in-process on the local node, without make,
+   ``hashsplit``, ``sort``, or one interpreter per task. Mappers and reducers
+   run in a pool of worker processes (see :mod:`multicore`); partitioning
+   and sorting are done in Python.
+
+   The job directory ends up exactly as if the Makefile had been run: map
+   output is partitioned into ``tmp/<input>/<rid>`` with the same hash as
+   ``hashsplit``, reducer output goes to ``out/<rid>``, and the ``.mapped``
+   and ``.reduced`` markers are touched. Thus, a later ``make`` considers the
+   job done, and jobs can be switched between the two executors freely.
+
+   Each reducer sorts its own input with :mod:`qr.sort`, within
+   ``--sortmem`` and spilling to ``--sortdir`` if needed.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import gzip
+import io
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+import multicore
+import testable
+import u
+from . import base
+from . import skew
+l = u.l
+
+
+### Main entry point ###
+
+def run(args, worker_ct):
+   '''Run the job described by args, which must already be set up with
+      :func:`qr.scripting.setup()`, in worker_ct local processes.'''
+   assert (args.python)
+   params = params_get(args)
+   if (args.balance):
+      pmap = skew.map_read('%s/tmp/partition_map' % (args.jobdir))
+   else:
+      pmap = None
+   input_bases = [os.path.basename(i) for i in args.inputs]
+   # As with make, inputs already mapped (e.g., before --update) are skipped.
+   inputs = [i for i in args.inputs if not map_done_p(args.jobdir, i)]
+   multicore.init(worker_ct)
+   l.info('running locally with %d workers' % (worker_ct))
+   t_start = time.time()
+   if (len(inputs) > 0):
+      bytes_ = multicore.do(map_task,
+                            (os.path.abspath(args.jobdir), args.python,
+                             params, args.file_reader, args.partitions,
+                             args.compress, pmap),
+                            inputs)
+   else:
+      bytes_ = []
+   t_map = time.time()
+   l.info('map: %d inputs (%d up to date), %s intermediate data in %s'
+          % (len(inputs), len(args.inputs) - len(inputs),
+             u.fmt_bytes(sum(bytes_)), u.fmt_seconds(t_map - t_start)))
+   multicore.do(reduce_task,
+                (os.path.abspath(args.jobdir), args.python, params,
+                 input_bases, args.sortdir, args.sortmem,
+                 args.fan_in, args.compress),
+                list(range(args.partitions)))
+   t_reduce = time.time()
+   l.info('reduce: %d partitions in %s'
+          % (args.partitions, u.fmt_seconds(t_reduce - t_map)))
+   l.info('done in %s' % (u.fmt_seconds(t_reduce - t_start)))
+
+
+### Tasks ###
+
+# These are module-level functions because they must be picklable. Both
+# expect to be run in their own process (they chdir and, in the case of
+# mappers, replace standard input).
+
+def map_task(jobdir, class_, params, read_cmd, nparts, compress, pmap,
+             filename):
+   '''Map input file filename and partition the output. Return the number of
+      bytes of map output.'''
+   os.chdir(jobdir)
+   ibase = os.path.basename(filename)
+   # Mappers read from standard input, so give them one. Note that worker
+   # processes replace sys.stdin with /dev/null, which need not be fd 0. Avoid
+   # a subprocess in the common case that the file is read as-is.
+   if (read_cmd == 'cat'):
+      proc = None
+      fd = os.open(filename, os.O_RDONLY)
+   else:
+      proc = sp.Popen('%s %s' % (read_cmd, filename), shell=True,
+                      stdout=sp.PIPE)
+      fd = proc.stdout.fileno()
+   os.dup2(fd, sys.stdin.fileno())
+   if (proc is None):
+      os.close(fd)
+   else:
+      proc.stdout.close()
+   job = u.class_by_name(class_)(params)
+   job.task = 'map-%s' % (ibase)
+   job.map_open_input()
+   if (isinstance(job, base.Partition_Output_Job)):
+      # the job partitions its own output
+      job.partition_open('tmp/%s' % (ibase), nparts, compress, pmap)
+      job.map_run()
+      bytes_ = job.partition_bytes
+   else:
+      job.outfp = tempfile.TemporaryFile(dir='tmp')
+      job.map_run()
+      job.outfp.seek(0)
+      bytes_ = partition(job.outfp, 'tmp/%s' % (ibase), nparts, compress,
+                         pmap)
+      job.outfp.close()
+   job.infp.close()
+   if (proc is not None and proc.wait() != 0):
+      raise sp.CalledProcessError(proc.returncode, read_cmd)
+   touch('tmp/%s.mapped' % (ibase))
+   return bytes_
+
+def reduce_task(jobdir, class_, params, input_bases, sortdir, sortmem, fan_in,
+                compressed, rid):
+   '''Sort and reduce partition rid. sortmem is a string in ``sort -S``
+      format.'''
+   os.chdir(jobdir)
+   job = u.class_by_name(class_)(params)
+   job.reduce_sort(rid, ['tmp/%s/%d' % (i, rid) for i in input_bases],
+                   sortdir, sortmem, fan_in, compressed=compressed)
+   touch('tmp/%d.reduced' % (rid))
+
+
+### Support functions ###
+
+def map_done_p(jobdir, filename):
+   '''Return True if input filename has a map marker no older than itself.'''
+   try:
+      return (os.path.getmtime('%s/tmp/%s.mapped'
+                               % (jobdir, os.path.basename(filename)))
+              >= os.path.getmtime(filename))
+   except FileNotFoundError:
+      return False
+
+def params_get(args):
+   '''Return the job parameters in args.pyargs as a Python object (see
+      ``--pyargs`` in :mod:`qr.scripting`).'''
+   if (args.pyargs is None or isinstance(args.pyargs, str)):
+      return u.str_to_dict(args.pyargs)
+   else:
+      return base.decode(args.pyargs)
+
+def partition(fp, basename, nparts, compress=False, pmap=None):
+   '''Split the lines of open file fp into nparts files basename/0,
+      basename/1, etc., in the same way as ``hashsplit`` (gzipped, like
+      ``hashsplit -z``, if compress; using partition map pmap, like
+      ``hashsplit -m``, if given). Return the number of bytes read. E.g.:
+
+      >>> tmp = tempfile.mkdtemp()
+      >>> lines = [b'b\\tx\\n', b'nullvaluenotab\\n', b'b\\ty\\n']
+      >>> partition(lines, tmp + '/p', 240)
+      23
+      >>> sorted(os.listdir(tmp + '/p'))[:3]
+      ['0', '1', '10']
+      >>> open(tmp + '/p/37', 'rb').read()
+      b'b\\tx\\nb\\ty\\n'
+      >>> open(tmp + '/p/145', 'rb').read()
+      b'nullvaluenotab\\n'
+      >>> partition(lines, tmp + '/z', 240, compress=True)
+      23
+      >>> gzip.open(tmp + '/z/37', 'rb').read()
+      b'b\\tx\\nb\\ty\\n'
+      >>> partition(lines, tmp + '/m', 240, pmap={ b'b': 5 })
+      23
+      >>> open(tmp + '/m/5', 'rb').read()
+      b'b\\tx\\nb\\ty\\n'
+      >>> shutil.rmtree(tmp)'''
+   outs = base.partition_open(basename, nparts, compress)
+   if (pmap is None):
+      pmap = dict()
+   bytes_ = 0
+   for line in fp:
+      outs[skew.partition_of(skew.key_of(line), nparts, pmap)].write(line)
+      bytes_ += len(line)
+   for out in outs:
+      out.close()
+   return bytes_
+
+def touch(filename):
+   io.open(filename, 'wb').close()
+
+
+testable.register('')
@@ -23,7 +23,6 @@
    an int, and we do it once per input line).'''
 
 
-import collections
 import datetime
 import glob
 import gzip
@@ -37,7 +36,10 @@ np.seterr(invalid='ignore')
 
 from . import base
 import math_
+import ngram_store
 import ssheet
+import testable
+import time_
 import tok.unicode_props
 import tsv_glue
 import tweet
@@ -45,35 +47,194 @@ import u
 import wikimedia
 
 
-class Build_Job(base.TSV_Internal_Job, base.KV_Pickle_Seq_Output_Job):
+# Number of n-grams Correlate_Job correlates at once; see
+# Correlate_Job.correlate_batch().
+CORRELATE_BATCH = 1024
+
+
+class Build_Job(base.Combine_Job, base.Partition_Output_Job,
+                base.TSV_Internal_Job, base.KV_Pickle_Seq_Output_Job):
+
+   '''Build daily time series of n-gram counts. Mappers call map_emit().
+
+      With param vocab_build, the job instead builds the first pass of a
+      vocabulary: it yields the totals of n-grams occurring at least min_occur
+      times, without time series. With param vocab, the path to a
+      vocabulary built from that (see ngram_store.Vocab), mappers emit
+      vocabulary ids rather than n-grams, dropping n-grams not in the
+      vocabulary, and reducers translate them back.'''
+
+   def combine(self, ngram, datecounts):
+      # Sum occurrences per day; mappers emit one (date, '1') per occurrence,
+      # so this shrinks the shuffle considerably for common n-grams.
+      cts = base.sum_by((date, int(count)) for (date, count) in datecounts)
+      for (date, count) in cts.items():
+         yield (date, str(count))
+
+   def map_emit(self, ngrams, date, count):
+      '''Yield key/value pairs for n-grams ngrams (bytes), each occurring
+         count times on proleptic Gregorian ordinal date (both strings).'''
+      if (self.params.get('vocab_build')):
+         date = '0'  # only totals needed, so let the combiner sum them all
+      elif (self.vocab is not None):
+         ngrams = [(ngram_store.ID_KEY_FMT % (i)).encode('ascii')
+                   for i in self.vocab.ids_of(ngrams) if i >= 0]
+      for ngram in ngrams:
+         yield (ngram, (date, count))
+
+   def map_init(self):
+      super(Build_Job, self).map_init()
+      self.vocab_open()
 
    def reduce(self, ngram, datecounts):
-      cts = collections.Counter()
-      first_day = float('+inf')
-      last_day = float('-inf')
-      for (date, count) in datecounts:
-         date = int(date)
-         count = int(count)
-         first_day = min(first_day, date)
-         last_day = max(last_day, date)
-         cts[date] += count
+      # Total by day as the values stream past, so memory use depends on the
+      # number of days rather than on how common the n-gram is.
+      cts = base.sum_by((int(date), int(count))
+                        for (date, count) in datecounts)
       total = sum(cts.values())
-      if (total >= self.params['min_occur']):
-         assert (first_day <= last_day)
-         # use float32 for space efficiency at the expense of precision
-         first_dt = datetime.date.fromordinal(first_day)
-         last_dt = datetime.date.fromordinal(last_day)
-         ct_series = math_.Date_Vector.zeros(first_dt, last_dt,
-                                             dtype=np.float32)
-         for (date, ct) in cts.items():
-            ct_series[date - first_day] = ct
+      if (total < self.params['min_occur']):
+         return
+      if (self.vocab is not None):
+         ngram = self.vocab.key_of(int(ngram))
+      if (self.params.get('vocab_build')):
          yield (ngram, { 'ngram': ngram,
-                         'total': total,
-                         'series': ct_series })
+                         'total': total })
+         return
+      first_day = min(cts)
+      last_day = max(cts)
+      # use float32 for space efficiency at the expense of precision
+      first_dt = datetime.date.fromordinal(first_day)
+      last_dt = datetime.date.fromordinal(last_day)
+      ct_series = math_.Date_Vector.zeros(first_dt, last_dt,
+                                          dtype=np.float32)
+      for (date, ct) in cts.items():
+         ct_series[date - first_day] = ct
+      yield (ngram, { 'ngram': ngram,
+                      'total': total,
+                      'series': ct_series })
+
+   def reduce_init(self):
+      super(Build_Job, self).reduce_init()
+      self.vocab_open()
+
+   def vocab_open(self):
+      if (self.params.get('vocab')):
+         self.vocab = ngram_store.Vocab(self.params['vocab'])
+      else:
+         self.vocab = None
 
 
 class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
 
+   def correlate_batch(self):
+      '''Correlate the n-grams in :attr:`batch` with every target at once,
+         and yield the key/value pairs for those which pass the thresholds.
+         The results are the same as computing :func:`math_.pearson()` for
+         each n-gram and target (after normalizing the n-gram and growing it
+         and the mask to the target), but all n-gram × target coefficients
+         come from a few matrix products: with M the target's mask, y the
+         target centered over M, and n the number of days in M, the
+         covariance of n-gram x with the target is x·y, and its variance is
+         x²·M - (x·M)²/n.'''
+      batch = self.batch
+      self.batch = list()
+      if (len(batch) == 0):
+         return
+      W = self.window_len
+      X = np.zeros((len(batch), W))
+      peak_own = np.full(len(batch), -np.inf)
+      trough_own = np.full(len(batch), np.inf)
+      span = np.zeros((len(batch), 2), dtype=np.int64)
+      for (i, ngram) in enumerate(batch):
+         proj = ngram['ngram'].split(' ')[0]
+         vec = ngram['series'].normalize(self.totals[proj]['series'],
+                                         parts_per=1e6)
+         valid = self.mask.resize(vec.first_day, vec.last_day).astype(bool)
+         if (valid.any()):
+            peak_own[i] = vec[valid].max()
+            trough_own[i] = vec[valid].min()
+         # place the n-gram in the window, zeros elsewhere
+         start = (vec.first_day - self.window_first).days
+         span[i] = (start, start + len(vec))
+         (lo, hi) = (max(start, 0), min(start + len(vec), W))
+         if (lo < hi):
+            X[i, lo:hi] = vec[lo - start:hi - start]
+      # Normalizing can yield NaN on days with no total (which should be
+      # masked out). Zero them so they don't poison the products, but
+      # remember any that a target doesn't mask; those correlations are NaN,
+      # as before.
+      bad = ~np.isfinite(X)
+      X[bad] = 0
+      unmasked_bad = (bad @ self.corr_mask) > 0
+      # Pearson coefficients, batch × targets
+      S1 = X @ self.corr_mask
+      S2 = (X * X) @ self.corr_mask
+      C = X @ self.corr_centered
+      var = np.maximum(S2 - S1**2 / self.corr_n, 0)
+      denom = np.sqrt(var) * self.corr_norm
+      ok = (denom > 0) & self.corr_ok
+      R = np.zeros_like(C)
+      R[ok] = C[ok] / denom[ok]
+      R[unmasked_bad & self.corr_ok] = np.nan
+      # Peak and trough: the n-gram is grown with zeros to cover the target,
+      # so zero counts if any valid day in the grown span is outside the
+      # n-gram's own span.
+      (ng_lo, ng_hi) = (span[:, 0:1], span[:, 1:2])
+      lo = np.clip(np.minimum(ng_lo, self.corr_first), 0, W)
+      hi = np.clip(np.maximum(ng_hi, self.corr_last), 0, W)
+      ng_lo = np.clip(ng_lo, 0, W)
+      ng_hi = np.clip(ng_hi, 0, W)
+      extra = ((self.valid_cum[hi] - self.valid_cum[lo])
+               > (self.valid_cum[ng_hi] - self.valid_cum[ng_lo]))
+      peak = np.where(extra, np.maximum(peak_own[:, None], 0),
+                      peak_own[:, None])
+      trough = np.where(extra, np.minimum(trough_own[:, None], 0),
+                        trough_own[:, None])
+      # (written this way so a NaN peak passes, as it always has)
+      hits = (~(peak < self.params['min_ppm'])
+              & (np.abs(R) >= self.params['min_similarity']))
+      for (i, t) in zip(*np.nonzero(hits)):
+         yield (self.targets[t]['name'],
+                (batch[i]['ngram'], float(R[i, t]), float(peak[i, t]),
+                 float(trough[i, t])))
+
+   def correlate_prepare(self):
+      '''Line up the global mask and the targets in a window spanning all the
+         targets, and precompute the per-target parts of the correlation (see
+         :meth:`correlate_batch()`).'''
+      self.window_first = min(t['series'].first_day for t in self.targets)
+      window_last = max(t['series'].last_day for t in self.targets)
+      self.window_len = (window_last - self.window_first).days + 1
+      mask = np.asarray(self.mask.resize(self.window_first, window_last),
+                        dtype=bool)
+      # valid_cum[j] is the number of valid days before day j of the window
+      self.valid_cum = np.concatenate(([0], np.cumsum(mask)))
+      T = len(self.targets)
+      self.corr_mask = np.zeros((self.window_len, T))
+      self.corr_centered = np.zeros((self.window_len, T))
+      self.corr_n = np.ones(T)
+      self.corr_norm = np.zeros(T)
+      self.corr_ok = np.zeros(T, dtype=bool)
+      self.corr_first = np.zeros(T, dtype=np.int64)
+      self.corr_last = np.zeros(T, dtype=np.int64)
+      for (j, t) in enumerate(self.targets):
+         assert (t['series'].bounds_eq(t['mask']))
+         first = (t['series'].first_day - self.window_first).days
+         last = first + len(t['series'])
+         m = mask[first:last] & np.asarray(t['mask'], dtype=bool)
+         y = np.asarray(t['series'], dtype=np.float64)
+         n = m.sum()
+         self.corr_first[j] = first
+         self.corr_last[j] = last
+         if (len(y) < 3 or n < 3):
+            continue  # not enough data; correlation is 0
+         yc = (y - y[m].mean()) * m
+         self.corr_mask[first:last, j] = m
+         self.corr_centered[first:last, j] = yc
+         self.corr_n[j] = n
+         self.corr_norm[j] = np.sqrt(np.sum(yc**2))
+         self.corr_ok[j] = True
+
    def map_init(self):
       pickle_ = u.pickle_load(self.params['total_file'])
       self.totals = pickle_['projects']
@@ -104,38 +265,21 @@ class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
             self.targets.append({ 'name':   name,
                                   'series': series,
                                   'mask':   mask })
+      self.correlate_prepare()
+      self.batch = list()
+      self.batch_size = self.params.get('batch_size', CORRELATE_BATCH)
 
    def map(self, kv):
-      (_, ngram) = kv
-      for t in self.targets:
-         # Aliases which make actual sense.
-         proj = ngram['ngram'].split(' ')[0]
-         ng_vec = ngram['series']
-         ng_mask = self.mask
-         trg_vec = t['series']
-         trg_mask = t['mask']
-         tot_vec = self.totals[proj]['series']
-         assert (trg_vec.bounds_eq(trg_mask))
-         # Normalize n-gram vector.
-         ng_vec = ng_vec.normalize(tot_vec, parts_per=1e6)
-         # The n-gram vector may have leading and trailing zeroes which are
-         # implicit; we need to make them explicit. (For example, if the first
-         # instance of an n-gram is on the second day of the target series,
-         # the n-gram vector will start on the second day, omitting the first
-         # day's zero -- but that zero needs to be part of the computation).
-         # However, we need to also extend the mask, in case it really is a
-         # no-data situation.
-         ng_vec = ng_vec.grow_to(trg_vec)
-         ng_mask = ng_mask.grow_to(trg_vec)
-         # Compute peak and trough, and ignore series with a too-low peak.
-         peak = ng_vec.max(ng_mask)
-         trough = ng_vec.min(ng_mask)
-         if (peak < self.params['min_ppm']):
-            continue
-         # Compute correlation.
-         r = math_.pearson(ng_vec, trg_vec, ng_mask, trg_mask)
-         if (abs(r) >= self.params['min_similarity']):
-            yield (t['name'], (ngram['ngram'], r, peak, trough))
+      # N-grams are correlated in batches; see correlate_batch().
+      self.batch.append(kv[1])
+      if (len(self.batch) >= self.batch_size):
+         for kv in self.correlate_batch():
+            yield kv
+
+   def map_flush(self):
+      for kv in self.correlate_batch():
+         self.map_write(*kv)
+      super(Correlate_Job, self).map_flush()
 
    def reduce_open_output(self):
       # output is opened in reduce()
@@ -165,17 +309,16 @@ class Tweet_Job(base.TSV_Input_Job, Build_Job):
    def map(self, fields):
       # WARNING: make sure field indices match any file format changes
       #
-      # Note: While we have an iso8601_parse() method in time_, it is kind of
-      # slow (~60 μs per parse on my box) and contains a number of
-      # contingencies we don't need here. In past experience, parsing dates
-      # once per input line consumes quite a lot of the total time, so we want
-      # to be expedient here (this approach takes ~9.5 µs). Another option
-      # would be to reprocess the Twitter data to include proleptic Gregorian
-      # ordinals directly (parsing ints takes only 250 ns).
-      date = str(datetime.datetime.strptime(fields[1][:10],  # date only
-                                            '%Y-%m-%d').toordinal())
-      for token in self.tzer.tokenize(fields[2]):  # tweet text
-         yield (('t@ ' + token).encode('utf8'), (date, '1'))
+      # Note: Parsing dates once per input line consumes quite a lot of the
+      # total time, so we want to be expedient here. We need only the date's
+      # proleptic Gregorian ordinal, which time_.iso8601_ordinal() computes
+      # from the date part alone without a full timestamp parse (and caches,
+      # since input is in time order). Another option would be to reprocess
+      # the Twitter data to include ordinals directly.
+      date = str(time_.iso8601_ordinal(fields[1][:10]))
+      return self.map_emit([('t@ ' + token).encode('utf8')
+                            for token in self.tzer.tokenize(fields[2])],
+                           date, '1')
 
 
 class Wikimedia_Job(Build_Job):
@@ -199,4 +342,72 @@ class Wikimedia_Job(Build_Job):
             project = fields[0]
             article = fields[1].replace('%20', '_')  # see issue #77
             count = fields[2]
-            yield (project + ' ' + article, (date, count))
+            for kv in self.map_emit([project + ' ' + article], date, count):
+               yield kv
+
+
+# Test-Depends: geo
+testable.register(r'''
+
+# Batched correlation gives the same results as the old per-pair code, which
+# is old_map() below. The totals have no data on two days: one masked out
+# globally, and one which target b doesn't mask, so n-grams covering it have
+# NaN correlations with b (and are dropped). Series y runs past both ends of
+# the window, and w is left for map_flush().
+>>> import io
+>>> DV = math_.Date_Vector
+>>> def old_map(job, ngram):
+...    for t in job.targets:
+...       proj = ngram['ngram'].split(' ')[0]
+...       ng_vec = ngram['series'].normalize(job.totals[proj]['series'],
+...                                          parts_per=1e6)
+...       ng_vec = ng_vec.grow_to(t['series'])
+...       ng_mask = job.mask.grow_to(t['series'])
+...       peak = ng_vec.max(ng_mask)
+...       trough = ng_vec.min(ng_mask)
+...       if (peak < job.params['min_ppm']):
+...          continue
+...       r = math_.pearson(ng_vec, t['series'], ng_mask, t['mask'])
+...       if (abs(r) >= job.params['min_similarity']):
+...          yield (t['name'], (ngram['ngram'], r, peak, trough))
+>>> job = Correlate_Job({ 'min_ppm': 0, 'min_similarity': 0.1 })
+>>> total = np.full(20, 1e6)
+>>> total[[3, 15]] = np.nan
+>>> job.totals = { 't@': { 'series': DV('2012-01-01', total) } }
+>>> job.mask = DV('2012-01-01', np.arange(20) != 3)
+>>> job.targets = [
+...    { 'name': 'a',
+...      'series': DV('2012-01-03', np.arange(10.0)),
+...      'mask': DV('2012-01-03', np.ones(10, dtype=bool)) },
+...    { 'name': 'b',
+...      'series': DV('2012-01-10', np.array([3., 1, 4, 1, 5, 9, 2, 6])),
+...      'mask': DV('2012-01-10', np.arange(8) != 2) }]
+>>> job.correlate_prepare()
+>>> job.batch = list()
+>>> job.batch_size = 3
+>>> def ngram(name, first_day, values):
+...    return { 'ngram': 't@ ' + name,
+...             'series': DV(first_day, np.array(values, dtype=np.float64)) }
+>>> ngrams = [ngram('x', '2012-01-04', [1, 2, 3, 5, 4]),
+...           ngram('y', '2012-01-01', np.arange(20) % 7),
+...           ngram('z', '2012-01-14', [2, 2, 9]),
+...           ngram('w', '2012-01-09', [1, 3, 2, 8, 1, 1, 4])]
+>>> expected = [kv for ng in ngrams for kv in old_map(job, ng)]
+>>> mapped = [kv for ng in ngrams for kv in job.map((None, ng))]
+>>> job.outfp = io.BytesIO()
+>>> job.map_flush()
+>>> job.infp = io.BytesIO(job.outfp.getvalue())
+>>> flushed = [(k, v) for (k, vs) in job.reduce_inputs() for v in vs]
+>>> [(k, v[0]) for (k, v) in mapped]
+[('a', 't@ x'), ('a', 't@ y')]
+>>> [(k, v[0]) for (k, v) in flushed]
+[('a', 't@ w'), ('b', 't@ w')]
+>>> def same(a, b):
+...    return (len(a) == len(b)
+...            and all(ka == kb and va[0] == vb[0]
+...                    and np.allclose(va[1:], vb[1:], equal_nan=True)
+...                    for ((ka, va), (kb, vb)) in zip(a, b)))
+>>> same(expected, mapped + flushed)
+True
+
+''')
@@ -0,0 +1,147 @@
+'''Summarize how a QUACreduce job ran, for tuning ``--partitions``,
+   ``--sortmem``, and the number of nodes.
+
+   Python mappers and reducers (see :mod:`qr.base`) save statistics for each
+   task in ``tmp/stats/<task>.json``: wall and CPU time, records in and out,
+   peak resident memory, and (for reducers which sort their own input) sort
+   time. The bytes in and out of each task are taken from the files in the
+   job directory, so they are available for shell jobs too.
+
+   The report has a section per phase. Tasks whose wall time is more than
+   STRAGGLER_FACTOR times the median are reported as stragglers, and
+   reducers whose input is more than SKEW_FACTOR times the mean as skewed
+   (see ``--balance``).'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import glob
+import json
+import os
+import statistics
+
+import testable
+import u
+
+
+# Tasks this much slower than the median are stragglers.
+STRAGGLER_FACTOR = 1.5
+
+# Reducers with this much more input than the mean are skewed.
+SKEW_FACTOR = 1.5
+
+
+def file_size(*patterns):
+   'Return the total size of files matching the given glob patterns.'
+   return sum(os.path.getsize(f) for p in patterns for f in glob.glob(p))
+
+def load(jobdir):
+   '''Return a dict with keys "map" and "reduce", each a list of task
+      dicts, for the job in jobdir. Each task has keys "task", "bytes_in",
+      and "bytes_out", plus those saved by the task itself, if any.'''
+   try:
+      manifest = u.pickle_load('%s/tmp/manifest' % (jobdir))
+   except IOError:
+      u.abort('--report: no job in %s' % (jobdir))
+   input_bases = [os.path.basename(i) for (i, _) in manifest['inputs']]
+   phases = { 'map': [], 'reduce': [] }
+   for (input_, _) in manifest['inputs']:
+      ibase = os.path.basename(input_)
+      phases['map'].append(
+         { 'task': 'map-%s' % (ibase),
+           'bytes_in': file_size(input_),
+           'bytes_out': file_size('%s/tmp/%s/*' % (jobdir, ibase)) })
+   for rid in range(manifest['args']['partitions']):
+      phases['reduce'].append(
+         { 'task': 'reduce-%d' % (rid),
+           'bytes_in': file_size(*('%s/tmp/%s/%d' % (jobdir, i, rid)
+                                   for i in input_bases)),
+           'bytes_out': file_size('%s/out/%d' % (jobdir, rid)) })
+   for task in phases['map'] + phases['reduce']:
+      try:
+         with open('%s/tmp/stats/%s.json' % (jobdir, task['task'])) as fp:
+            task.update(json.load(fp))
+      except FileNotFoundError:
+         pass
+   return phases
+
+def report(jobdir):
+   'Return a report on the job in jobdir, as a list of lines.'
+   phases = load(jobdir)
+   return summarize('map', phases['map']) + summarize('reduce',
+                                                      phases['reduce'])
+
+def summarize(phase, tasks):
+   '''Return a summary of tasks, which are in phase phase, as a list of
+      lines. E.g.:
+
+      >>> tasks = [{ 'task': 'reduce-%d' % (i), 'bytes_in': b,
+      ...            'bytes_out': 10, 'wall': w, 'cpu_user': w / 2,
+      ...            'cpu_sys': 0, 'records_in': 2, 'records_out': 1,
+      ...            'rss_peak': 2**20 * (i+1), 'sort_time': None }
+      ...          for (i, (b, w)) in enumerate([(100, 60), (400, 240),
+      ...                                        (100, 60), (100, 50)])]
+      >>> print('\\n'.join(summarize('reduce', tasks)))
+      reduce: 4 tasks, 4 with statistics
+        bytes in:      700.00B total, 175.00B mean, 400.00B max (reduce-1)
+        bytes out:     40.00B total, 10.00B mean, 10.00B max (reduce-0)
+        skewed:        reduce-1, 2.3 times mean input
+        records in:    8 total
+        records out:   4 total
+        wall time:     0:06:50 total, 0:01:42 mean, 0:04:00 max (reduce-1)
+        CPU time:      0:03:25 total, 50% of wall
+        peak memory:   4.00MiB max (reduce-3)
+        straggler:     reduce-1, 4.0 times median wall time
+      >>> print('\\n'.join(summarize('map', [{ 'task': 'map-a',
+      ...                                      'bytes_in': 0,
+      ...                                      'bytes_out': 0 }])))
+      map: 1 tasks, 0 with statistics
+        bytes in:      0.00B total, 0.00B mean, 0.00B max (map-a)
+        bytes out:     0.00B total, 0.00B mean, 0.00B max (map-a)
+      >>> summarize('map', [])
+      ['map: 0 tasks, 0 with statistics']'''
+   stats = [t for t in tasks if 'wall' in t]
+   lines = ['%s: %d tasks, %d with statistics' % (phase, len(tasks),
+                                                 len(stats))]
+   if (len(tasks) == 0):
+      return lines
+   def line(label, text):
+      lines.append('  %-14s %s' % (label + ':', text))
+   def spread(key, fmt, tasks=tasks):
+      values = [t[key] for t in tasks]
+      top = max(tasks, key=lambda t: t[key])
+      return ('%s total, %s mean, %s max (%s)'
+              % (fmt(sum(values)), fmt(statistics.mean(values)),
+                 fmt(top[key]), top['task']))
+   line('bytes in', spread('bytes_in', u.fmt_bytes))
+   line('bytes out', spread('bytes_out', u.fmt_bytes))
+   if (phase == 'reduce'):
+      mean = statistics.mean(t['bytes_in'] for t in tasks)
+      for t in tasks:
+         if (len(tasks) > 1 and t['bytes_in'] > SKEW_FACTOR * mean):
+            line('skewed', '%s, %.1f times mean input'
+                 % (t['task'], t['bytes_in'] / mean))
+   if (len(stats) == 0):
+      return lines
+   line('records in', '%d total' % (sum(t['records_in'] for t in stats)))
+   line('records out', '%d total' % (sum(t['records_out'] for t in stats)))
+   line('wall time', spread('wall', u.fmt_seconds, stats))
+   wall = sum(t['wall'] for t in stats)
+   cpu = sum(t['cpu_user'] + t['cpu_sys'] for t in stats)
+   line('CPU time', '%s total, %d%% of wall'
+        % (u.fmt_seconds(cpu), 100 * cpu / max(wall, 1e-9)))
+   sorts = [t for t in stats if t.get('sort_time') is not None]
+   if (len(sorts) > 0):
+      line('sort time', spread('sort_time', u.fmt_seconds, sorts))
+   top = max(stats, key=lambda t: t['rss_peak'])
+   line('peak memory', '%s max (%s)' % (u.fmt_bytes(top['rss_peak']),
+                                        top['task']))
+   median = statistics.median(t['wall'] for t in stats)
+   for t in stats:
+      if (len(stats) > 1 and t['wall'] > STRAGGLER_FACTOR * median):
+         line('straggler', '%s, %.1f times median wall time'
+              % (t['task'], t['wall'] / median))
+   return lines
+
+
+testable.register('')
@@ -17,6 +17,8 @@ Notes:
 
   * If --reduce includes the string "%RID", it is replaced with the reducer
     ID; this is important for coordinating output files if --partitions > 1.
+    Similarly, "%(IBASE)" in --map is replaced with the input file's
+    basename.
 
   * --python is mutually exclusive with --map and --reduce (which must both be
     specified if one is).
@@ -30,15 +32,54 @@ Notes:
 
     * A Python object serialized with :func:`qr.base.encode()`.
 
+  * --balance samples the map output before mapping starts and assigns the
+    heaviest keys to partitions explicitly, rather than by hash, so that
+    skewed keys (e.g., very common n-grams) don't overload one reducer. The
+    assignments are saved in JOBDIR/tmp/partition_map and kept for --update.
+
   * --sortdir probably should not, if possible, be on the shared filesystem;
     the point is to leverage node-local storage for sorting during the
     partitioning phase. However, this storage must be available on the same
     path for each node.
 
+  * --native-sort makes Python reducers read and sort their own input, which
+    avoids a write and read of each partition and compresses sort temporary
+    files. --fan-in limits how many sorted runs are merged at once.
+
+  * --compress stores the partitioned map output gzipped, at the fastest
+    setting. This trades some CPU time for much less intermediate data to
+    write, keep, and read back; it is a win when the job directory is on a
+    slow or shared filesystem.
+
+  * In addition to the Makefile, the job directory gets SLURM job array
+    scripts; run JOBDIR/slurm_job to submit them. These sort in $TMPDIR on
+    each node if --sortdir is not given.
+
+  * With --dist, --retries N runs failed tasks up to N more times on other
+    hosts, and --speculate F starts a duplicate of any mapper which takes
+    longer than F times the median mapper, on another host; the first copy to
+    finish wins. Speculation requires deterministic mappers. (Reducers are not
+    speculated, because their output is up to the job.)
+
   * Input files need not exist at quacreduce time; this gives you greater
     flexibility in when to build the job.
 
+  * --update adds the given input files (if any) to the existing job in
+    JOBDIR, taking the job definition from it, and arranges for only new and
+    changed inputs to be mapped. If the job is --associative, reducers keep
+    their sorted input so that after an update they need sort only the new
+    map output and merge it in.
+
   * Beware shell quoting with --map and --reduce!
+
+  * --report summarizes the job in JOBDIR: bytes in and out of each phase,
+    and for Python jobs, time, records, and memory, from statistics each
+    task saves in JOBDIR/tmp/stats. Slow tasks and skewed partitions are
+    pointed out.
+
+  * --local runs the job immediately in N local processes, without make or
+    the usual helper programs. It requires --python. The job directory is
+    left exactly as a make run would leave it.
 '''
 
 import os
@@ -47,10 +88,57 @@ import subprocess as sp
 import time_
 import u
 import qr.base
+import qr.local
+import qr.report
+import qr.skew
+import qr.sort
 l = u.l
 
-# This command returns false if the first command in the previous pipe failed.
-PIPEFAIL = 'if [ $${PIPESTATUS[1]} -ne 0 ]; then false; fi'
+# This command returns false if any command in the previous pipe failed.
+PIPEFAIL = 'for s in $${PIPESTATUS[@]}; do if [ $$s -ne 0 ]; then false; fi; done'
+
+# Arguments which define the job, as opposed to how it is run. --update
+# takes these from the manifest of the existing job.
+MANIFEST_ARGS = ('map', 'reduce', 'python', 'pyargs', 'partitions',
+                 'associative', 'compress', 'balance')
+
+# Beginning and end of the SLURM job array scripts; see slurm_dump(). Each
+# task is one arm of a case statement on the array index.
+SLURM_PREAMBLE = '''\
+#!/bin/bash
+#SBATCH --job-name=qr-%(phase)s
+#SBATCH --array=0-%(last)d
+#SBATCH --output=tmp/slurm-%(phase)s-%%a.out
+
+# This is a QUACreduce %(phase)s job array for SLURM, generated %(now)s.
+# Submit it with slurm_job.
+
+set -e -o pipefail
+cd %(jobdir)s
+
+# Exit successfully if marker file $1 exists and is no older than any of the
+# remaining arguments, i.e., this task is already done.
+up_to_date () {
+   test -e $1 || return 0
+   marker=$1
+   shift
+   for i in "$@"; do
+      test $i -nt $marker && return 0
+   done
+   echo "$marker is up to date"
+   exit 0
+}
+
+case $SLURM_ARRAY_TASK_ID in
+'''
+SLURM_POSTAMBLE = '''\
+   *)
+      echo "invalid task ID: $SLURM_ARRAY_TASK_ID" 1>&2
+      exit 1
+      ;;
+esac
+touch $done_
+'''
 
 
 
@@ -63,6 +151,8 @@ def parse_args(ap):
    # parse args
    args = u.parse_args(ap)
    # check arguments
+   if (len(args.inputs) == 0 and not (args.update or args.report)):
+      ap.error('at least one input file is required')
    if (len(set(os.path.basename(i) for i in args.inputs)) != len(args.inputs)):
       ap.error('input file basenames must be unique')
    # absolutize input files
@@ -70,29 +160,52 @@ def parse_args(ap):
    # set sortdir if unset
    if (args.sortdir is None):
       args.sortdir = 'tmp'
+   # set partitions if unset (--update gets it from the existing job)
+   if (args.partitions is None and not args.update):
+      args.partitions = 1
    # done
    return args
 
 def run(args, job_ct):
+   if (args.local is not None):
+      if (args.balance
+          and not os.path.exists('%s/tmp/partition_map' % (args.jobdir))):
+         sp.check_call(sample_cmd(args), shell=True, cwd=args.jobdir,
+                       executable='/bin/bash')
+      qr.local.run(args, args.local)
+      return
    sp.check_call('cd %s && make -j%d' % (args.jobdir, job_ct), shell=True)
 
 def setup(args):
+   args.merge_runs = dict()
+   args.map_partition = None
+   if (args.update):
+      update_prepare(args)
    # These tests are here, rather than in argument parsing, so scripts can
    # insert mappers and reducers not specified on the command line.
    if (not (args.map and args.reduce or args.python)):
       u.abort('must specify both mapper and reducer')
    if (args.map and args.reduce and args.python):
       u.abort('cannot specify all of --python, --map, --reduce')
+   if ((args.retries or args.speculate is not None) and not args.dist):
+      u.abort('--retries and --speculate require --dist')
+   if (args.local is not None and not args.python):
+      u.abort('--local requires --python')
+   if (args.native_sort and not args.python):
+      u.abort('--native-sort requires --python')
 
    # Bad script might screw this up. It's a programming problem, not a user
    # problem, so assert instead of erroring.
    assert (len(args.inputs) > 0)
 
    directories_setup(args)
+   manifest = { 'args': { a: getattr(args, a) for a in MANIFEST_ARGS },
+                'inputs': [(i, stat(i)) for i in args.inputs] }
    if (args.python):
       pythonify(args)
    makefile_dump(args)
    slurm_dump(args)
+   u.pickle_dump('%s/tmp/manifest' % (args.jobdir), manifest)
 
 
 ### Classes ###
@@ -113,14 +226,31 @@ class ArgumentParser(u.ArgumentParser):
       gr.add_argument('--pyargs',
                       metavar='DICT',
                       help='Parameters for Python job')
+      gr.add_argument('--associative',
+                      action='store_true',
+                      help='reducer input can be merged incrementally')
       gr = self.add_argument_group('job logistics')
       gr.add_argument('inputs',
                       metavar='FILE',
-                      nargs='+',
+                      nargs='*',
                       help='input files (must have unique names)')
       gr.add_argument('--dist',
                       action='store_true',
                       help='run distributed using sshrot')
+      gr.add_argument('--retries',
+                      type=int,
+                      metavar='N',
+                      default=0,
+                      help='with --dist, retry failed tasks N times')
+      gr.add_argument('--speculate',
+                      type=float,
+                      metavar='F',
+                      help=('with --dist, duplicate mappers slower than F '
+                            'times the median'))
+      gr.add_argument('--local',
+                      type=int,
+                      metavar='N',
+                      help='run in-process with N workers instead of make')
       gr.add_argument('--file-reader',
                       metavar='CMD',
                       default='cat',
@@ -132,8 +262,10 @@ class ArgumentParser(u.ArgumentParser):
       gr.add_argument('--partitions',
                       type=int,
                       metavar='N',
-                      default=1,
                       help='number of partitions to use (default 1)')
+      gr.add_argument('--balance',
+                      action='store_true',
+                      help='balance partitions using a sample of map output')
       gr.add_argument('--sortdir',
                       metavar='DIR',
                       help='directory for sort temp files (default JOBDIR)')
@@ -141,9 +273,24 @@ class ArgumentParser(u.ArgumentParser):
                       metavar='N',
                       default='64M',
                       help='sort memory to use (sort -S; default 64M)')
+      gr.add_argument('--native-sort',
+                      action='store_true',
+                      help='Python reducers sort their own input')
+      gr.add_argument('--fan-in',
+                      type=int,
+                      metavar='N',
+                      default=qr.sort.FAN_IN,
+                      help=('merge fan-in for --native-sort (default %d)'
+                            % (qr.sort.FAN_IN)))
+      gr.add_argument('--compress',
+                      action='store_true',
+                      help='gzip intermediate map output')
       gr.add_argument('--update',
                       action='store_true',
-                      help='add more input (not implemented; see issue #36)')
+                      help='add more input to the existing job in JOBDIR')
+      gr.add_argument('--report',
+                      action='store_true',
+                      help='summarize how the job in JOBDIR ran, and exit')
       return super(ArgumentParser, self).parse_args(args)
 
 
@@ -158,16 +305,32 @@ def makefile_dump(args):
    fp = open('%s/Makefile' % (args.jobdir), 'w')
    if (args.dist):
       shell = 'sshrot'
+      flags = '-ec --retries %d' % (args.retries)
+      if (args.speculate is not None):
+         flags += ' --speculate %g' % (args.speculate)
    else:
       shell = '/bin/bash'
+      flags = '-ec'
    fp.write('''\
 # This is a QUACreduce job, generated %s.
 
 SHELL=%s
-.SHELLFLAGS=-ec
+.SHELLFLAGS=%s
 
 '''
-            % (time_.nowstr_human(), shell))
+            % (time_.nowstr_human(), shell, flags))
+   if (args.dist and args.speculate is not None):
+      # Only mappers are speculated, because their output is entirely under
+      # our control; see map_publish().
+      fp.write('tmp/%.mapped: export SSHROT_GROUP=map\n\n')
+   if (args.dist):
+      # Run each reducer on the node which wrote most of its input, where
+      # that input is likely still cached.
+      fp.write('''\
+tmp/%.mapped: export SSHROT_OUTPUTS=tmp/$(basename $(@F))
+tmp/%.reduced: export SSHROT_INPUTS=tmp/*/$(basename $(@F))
+
+''')
    # everything
    fp.write('all: %s\n' % (' '.join('tmp/%d.reduced' % (i)
                                     for i in range(args.partitions))))
@@ -179,55 +342,332 @@ clean:
 reallyclean: clean
 	rm -Rf out/*
 ''')
+   # sampling (no prerequisites, so it's never redone; see qr.skew)
+   if (args.balance):
+      fp.write('''
+tmp/partition_map:
+	%s && %s
+''' % (sample_cmd(args), PIPEFAIL))
    # mappers
    for filename in args.inputs:
+      ibase = os.path.basename(filename)
+      if (args.dist and args.speculate is not None):
+         (mapout, publish) = map_publish(ibase)
+         publish = ' && ' + publish
+      else:
+         (mapout, publish) = ('tmp/%s' % (ibase), '')
       fp.write('''
-%(mapdone)s: %(input)s
-	%(read_cmd)s %(input)s | %(map_cmd)s | %(hashsplit)s %(nparts)d tmp/%(ibase)s && %(pipefail)s
+%(mapdone)s: %(input)s%(pmap)s
+	%(read_cmd)s %(input)s | %(map_cmd)s && %(pipefail)s%(publish)s
 	touch %(mapdone)s
-''' % { 'ibase': os.path.basename(filename),
-        'input': filename,
-        'hashsplit': '%s/bin/hashsplit' % u.quacbase,
-        'map_cmd': args.map,
-        'mapdone': 'tmp/%s.mapped' % (os.path.basename(filename)),
-        'nparts': args.partitions,
+''' % { 'input': filename,
+        'map_cmd': map_cmd(args, ibase, mapout),
+        'mapdone': 'tmp/%s.mapped' % (ibase),
         'pipefail': PIPEFAIL,
+        'pmap': ' | tmp/partition_map' if args.balance else '',
+        'publish': publish,
         'read_cmd': args.file_reader })
    # reducers
    for rid in range(args.partitions):
       input_bases = [os.path.basename(i) for i in args.inputs]
-      cmd = args.reduce.replace('%(RID)', str(rid))
+      (cmd, after) = reduce_cmd(args, rid, args.sortdir)
       fp.write('''
 %(reducedone)s: %(mapdones)s
-	LC_ALL=C sort -s -k1,1 -t'	' -S %(buf)s -T %(sortdir)s %(mapouts)s | %(cmd)s && %(pipefail)s
-	touch %(reducedone)s
-''' % { 'buf': args.sortmem,
+	%(cmd)s && %(pipefail)s
+%(after)s	touch %(reducedone)s
+''' % { 'after': ''.join('\t%s\n' % (i) for i in after),
         'cmd': cmd,
         'mapdones': ' '.join('tmp/%s.mapped' % (i) for i in input_bases),
-        'mapouts': ' '.join('tmp/%s/%d' % (i, rid) for i in input_bases),
         'pipefail': PIPEFAIL,
-        'rid': rid,
-        'reducedone': 'tmp/%d.reduced' % (rid),
-        'sortdir': args.sortdir })
+        'reducedone': 'tmp/%d.reduced' % (rid) })
    fp.close()
 
+def map_publish(ibase):
+   '''Return a pair: the directory where a speculated mapper of input ibase
+      should write its partitions, and a shell command which then moves them
+      into place. This lets duplicate mappers (see sshrot --speculate) run at
+      the same time, since each writes to its own directory, named for its
+      host and process ID, and renaming each file over any copy already in
+      place is atomic. Reducers thus see either copy, but never a partial
+      one. Note the escaping for make.'''
+   private = 'tmp/%s.$$(hostname).$$$$' % (ibase)
+   return (private, 'mkdir -p tmp/%s && mv -f %s/* tmp/%s && rmdir %s'
+                    % (ibase, private, ibase, private))
+
+def map_cmd(args, ibase, mapout):
+   '''Return the shell pipeline which maps standard input, which is input
+      file ibase, and partitions the result into directory mapout. Usually
+      this is the mapper piped into hashsplit, but Python jobs with
+      qr.base.Partition_Output_Job partition their own output.'''
+   if (args.map_partition):
+      return (args.map_partition.replace('%(IBASE)', ibase)
+              .replace('%(MAPOUT)', mapout))
+   return '%s | %s %d %s' % (args.map.replace('%(IBASE)', ibase),
+                             hashsplit_cmd(args), args.partitions, mapout)
+
+def partition_inline_p(class_):
+   '''Return True if Python job class class_ (a fully qualified name)
+      partitions its own output, i.e., has qr.base.Partition_Output_Job.
+      If the class can't be imported here, say False; the job then pipes
+      through hashsplit, which gives the same result.'''
+   try:
+      return issubclass(u.class_by_name(class_), qr.base.Partition_Output_Job)
+   except (ImportError, ValueError):
+      return False
+
 def pythonify(args):
-   'Adjust args.map and args.reduce to call the appropriate Python methods.'
+   '''Adjust args.map and args.reduce (and args.map_partition, for jobs which
+      partition their own output) to call the appropriate Python methods.'''
    assert (args.python)
    module = args.python.rpartition('.')[0]
    class_ = args.python
    # Note: args.pyargs might not really be a string representation of a
    # dictionary. See base.Job.__init__() for more on how this hack works.
-   if (type(args.pyargs) is not str):
-      params = qr.base.decode(args.pyargs)
-   else:
-      params = repr(u.str_to_dict(args.pyargs))
-      
+   params = repr(qr.local.params_get(args))
    base = "python3 -c \"import %(module)s; j = %(class_)s(%(params)s); " % locals()
    if (args.map is None):
-      args.map = base + "j.map_stdinout()\""
+      args.map = base + "j.map_stdinout('%(IBASE)')\""
+      if (partition_inline_p(class_)):
+         args.map_partition = (base + "j.map_partition('%%(IBASE)', "
+                               "'%%(MAPOUT)', %d, %s, %r)\""
+                               % (args.partitions, args.compress,
+                                  'tmp/partition_map' if args.balance
+                                  else None))
    if (args.reduce is None):
-      args.reduce = base + "j.reduce_stdinout(%(RID))\""
+      if (args.native_sort):
+         args.reduce = base + "j.reduce_sort(%(RID), %(SORT))\""
+      else:
+         args.reduce = base + "j.reduce_stdinout(%(RID))\""
 
 def slurm_dump(args):
-   pass  # unimplemented, see issue #33
+   '''Write three files into the job directory that run the job under SLURM
+      without make: ``slurm_map`` and ``slurm_reduce`` are job array batch
+      scripts with one task per input and per partition respectively, and
+      ``slurm_job`` submits them with sbatch, reducers depending on mappers.
+      As with the Makefile, tasks whose marker files are up to date exit
+      immediately, so a failed or extended job can simply be resubmitted.'''
+   jobdir = os.path.abspath(args.jobdir)
+   input_bases = [os.path.basename(i) for i in args.inputs]
+   # The default sortdir is in the job directory, i.e., on the shared
+   # filesystem, which is a poor choice on a cluster. Use node-local storage
+   # instead.
+   if (args.sortdir == 'tmp'):
+      sortdir = '${TMPDIR:-/tmp}'
+   else:
+      sortdir = args.sortdir
+   # driver; sampling for --balance is quick, so it runs here rather than as
+   # its own job
+   if (args.balance):
+      sample_driver = ('test -e tmp/partition_map || { %s; }\n'
+                       % (sample_cmd(args)))
+   else:
+      sample_driver = ''
+   fp = open('%s/slurm_job' % (jobdir), 'w')
+   fp.write('''\
+#!/bin/bash
+
+# This is a QUACreduce job for SLURM, generated %(now)s.
+#
+# Run this script (don't sbatch it) to submit the mappers and reducers as two
+# job arrays. Arguments are passed to both sbatch invocations (e.g., --time).
+
+set -e
+cd %(jobdir)s
+%(sample)smap_id=$(${SBATCH:-sbatch} --parsable "$@" slurm_map)
+${SBATCH:-sbatch} --parsable --dependency=afterok:${map_id%%%%;*} "$@" slurm_reduce
+''' % { 'jobdir': jobdir,
+        'now': time_.nowstr_human(),
+        'sample': sample_driver })
+   fp.close()
+   os.chmod('%s/slurm_job' % (jobdir), 0o755)
+   # mappers
+   fp = open('%s/slurm_map' % (jobdir), 'w')
+   fp.write(SLURM_PREAMBLE % { 'jobdir': jobdir,
+                               'last': len(args.inputs) - 1,
+                               'now': time_.nowstr_human(),
+                               'phase': 'map' })
+   for (i, filename) in enumerate(args.inputs):
+      fp.write('''\
+   %(i)d)
+      done_=tmp/%(ibase)s.mapped
+      up_to_date $done_ %(input)s
+      %(read_cmd)s %(input)s | %(map_cmd)s
+      ;;
+''' % { 'i': i,
+        'ibase': input_bases[i],
+        'input': filename,
+        'map_cmd': map_cmd(args, input_bases[i],
+                           'tmp/%s' % (input_bases[i])),
+        'read_cmd': args.file_reader })
+   fp.write(SLURM_POSTAMBLE)
+   fp.close()
+   # reducers
+   fp = open('%s/slurm_reduce' % (jobdir), 'w')
+   fp.write(SLURM_PREAMBLE % { 'jobdir': jobdir,
+                               'last': args.partitions - 1,
+                               'now': time_.nowstr_human(),
+                               'phase': 'reduce' })
+   for rid in range(args.partitions):
+      (cmd, after) = reduce_cmd(args, rid, sortdir)
+      fp.write('''\
+   %(rid)d)
+      done_=tmp/%(rid)d.reduced
+      up_to_date $done_ %(mapdones)s
+      mkdir -p %(sortdir)s
+      %(cmd)s
+%(after)s      ;;
+''' % { 'after': ''.join('      %s\n' % (i) for i in after),
+        'cmd': cmd,
+        'mapdones': ' '.join('tmp/%s.mapped' % (i) for i in input_bases),
+        'rid': rid,
+        'sortdir': sortdir })
+   fp.write(SLURM_POSTAMBLE)
+   fp.close()
+
+def hashsplit_cmd(args):
+   'Return the command which partitions map output.'
+   cmd = '%s/bin/hashsplit' % (u.quacbase)
+   if (args.compress):
+      cmd += ' -z'
+   if (args.balance):
+      cmd += ' -m tmp/partition_map'
+   return cmd
+
+def reduce_cmd(args, rid, sortdir):
+   '''Return a pair: the shell pipeline which runs reducer rid, including
+      sorting its input, and a list of shell commands to run after that
+      succeeds. Usually this is a sort of partition rid of all the map outputs
+      (decompressed first with --compress) piped into the reducer; with
+      --native-sort, the Python reducer reads and sorts the map outputs
+      itself (see qr.sort).
+
+      For --associative jobs, the sorted input is also saved, along with a
+      list of the inputs it covers, so that a later --update can merge the new
+      map outputs into it rather than sorting everything again (see
+      update_prepare()).'''
+   input_bases = [os.path.basename(i) for i in args.inputs]
+   mapouts = lambda bases: ['tmp/%s/%d' % (i, rid) for i in bases]
+   cmd = args.reduce.replace('%(RID)', str(rid))
+   run = 'tmp/%d.sorted' % (rid)
+   new = args.merge_runs.get(rid)
+   if (args.associative):
+      after = ['mv %s.tmp %s' % (run, run),
+               'echo %s > %s.inputs' % (' '.join(input_bases), run)]
+   else:
+      after = []
+   if (args.native_sort):
+      if (not args.associative):
+         sort_args = (mapouts(input_bases), [], None)
+      elif (new is None):
+         sort_args = (mapouts(input_bases), [], run + '.tmp')
+      else:
+         sort_args = (mapouts(new), [run], run + '.tmp')
+      cmd = cmd.replace('%(SORT)', '%r, %r, %r, %d, %r, %r, %r'
+                        % ((sort_args[0], sortdir, args.sortmem, args.fan_in)
+                           + sort_args[1:] + (args.compress,)))
+      return (cmd, after)
+   sort = ("LC_ALL=C sort -s -k1,1 -t'\t' -S %s -T %s"
+           % (args.sortmem, sortdir))
+   if (args.compress):
+      # Concatenating the map outputs and sorting stably gives the same
+      # order as sorting the files directly.
+      sort_new = lambda bases: 'zcat %s | %s' % (' '.join(mapouts(bases)),
+                                                 sort)
+   else:
+      sort_new = lambda bases: '%s %s' % (sort, ' '.join(mapouts(bases)))
+   if (not args.associative or new is None):
+      sort_cmd = sort_new(input_bases)
+   elif (len(new) == 0):
+      sort_cmd = 'cat %s' % (run)
+   else:
+      # sort -m -s prefers earlier files on ties, so the old values for each
+      # key stay ahead of the new ones, as they would in a full sort.
+      sort_cmd = '%s | %s -m %s -' % (sort_new(new), sort, run)
+   if (args.associative):
+      sort_cmd += ' | tee %s.tmp' % (run)
+   return ('%s | %s' % (sort_cmd, cmd), after)
+
+def sample_cmd(args):
+   '''Return the shell pipeline which maps a sample of the input and writes
+      the partition map for --balance (see qr.skew). The sampled inputs must
+      exist; note that a mapper which fails is an error, but one which stops
+      reading early is fine.'''
+   maps = ['%s %s | head -n %d | %s; '
+           % (args.file_reader, i, qr.skew.SAMPLE_LINES,
+              args.map.replace('%(IBASE)', ''))
+           for i in qr.skew.sample_inputs(args.inputs)]
+   return ('(%s) | %s/bin/partition-plan %d tmp/partition_map'
+           % (''.join(maps), u.quacbase, args.partitions))
+
+def stat(filename):
+   '''Return a summary of filename that changes when it does, or None if it
+      doesn't exist.'''
+   try:
+      st = os.stat(filename)
+      return (st.st_mtime, st.st_size)
+   except FileNotFoundError:
+      return None
+
+def update_prepare(args):
+   '''Reconcile args with the existing job in args.jobdir, as recorded in its
+      manifest by setup(). Specifically:
+
+        1. Job-defining arguments (see MANIFEST_ARGS) that weren't given are
+           taken from the manifest; those that were given must match it.
+
+        2. Inputs of the existing job are kept, in the same order, and new
+           ones are appended.
+
+        3. Inputs which have changed since the manifest was written (by
+           modification time or size) have their map marker removed, so they
+           are mapped again even if make wouldn't notice.
+
+        4. For --associative jobs, each partition whose saved sorted input
+           covers a prefix of the inputs, none of which changed, is scheduled
+           for merging rather than re-sorting, by setting args.merge_runs[rid]
+           to the list of inputs not yet covered.'''
+   try:
+      manifest = u.pickle_load('%s/tmp/manifest' % (args.jobdir))
+   except IOError:
+      u.abort('--update: no existing job in %s' % (args.jobdir))
+   for a in MANIFEST_ARGS:
+      old = manifest['args'].get(a)
+      new = getattr(args, a)
+      if (new is None or new is False):
+         setattr(args, a, old)
+      elif (new != old and a != 'associative'):
+         u.abort('--update: --%s differs from existing job' % (a))
+   # inputs
+   old_inputs = [i for (i, _) in manifest['inputs']]
+   new_inputs = [i for i in args.inputs if i not in set(old_inputs)]
+   args.inputs = old_inputs + new_inputs
+   input_bases = [os.path.basename(i) for i in args.inputs]
+   if (len(set(input_bases)) != len(input_bases)):
+      u.abort('--update: input file basenames must be unique')
+   changed = set(os.path.basename(i) for (i, st) in manifest['inputs']
+                 if stat(i) != st)
+   for i in changed:
+      try:
+         os.unlink('%s/tmp/%s.mapped' % (args.jobdir, i))
+      except FileNotFoundError:
+         pass
+   if (len(changed) > 0):
+      # Saved sorted inputs contain the old map output of changed inputs, so
+      # they can't be merged into any more.
+      for rid in range(args.partitions):
+         try:
+            os.unlink('%s/tmp/%d.sorted.inputs' % (args.jobdir, rid))
+         except FileNotFoundError:
+            pass
+   l.info('update: %d new inputs, %d changed'
+          % (len(new_inputs), len(changed)))
+   # merge plan
+   if (args.associative):
+      for rid in range(args.partitions):
+         try:
+            done = open('%s/tmp/%d.sorted.inputs'
+                        % (args.jobdir, rid)).read().split()
+         except FileNotFoundError:
+            continue
+         if (done == input_bases[:len(done)]):
+            args.merge_runs[rid] = input_bases[len(done):]
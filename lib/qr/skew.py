@@ -0,0 +1,164 @@
+'''Skew-aware partitioning of QUACreduce map output.
+
+   Normally, ``hashsplit`` assigns each key to a partition by hash. That
+   balances the number of keys per reducer, but not the amount of data: with
+   Zipf-distributed keys (e.g., n-grams like "the" or "rt", or popular
+   Wikipedia articles), the partition which happens to get the heaviest keys
+   is much larger than the rest, and its reducer holds up the whole job.
+
+   With ``--balance``, a sample of the map output is taken before mapping
+   starts, and keys heavy enough to matter are assigned to partitions
+   explicitly, heaviest first, each to the partition with the least estimated
+   load so far (the lighter keys stay hashed). The assignments are written to
+   a *partition map* file, which ``hashsplit -m`` and :mod:`qr.local` consult
+   before hashing. Each key still goes to exactly one reducer, so no job
+   changes are needed; the largest partition ends up about the size of the
+   heaviest key or of the average partition, whichever is greater.
+
+   Partition map files have one line per key, ``KEY<tab>PARTITION``.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import collections
+import io
+import shutil
+
+import hash_
+import testable
+
+
+# Number of input lines to map from each sampled input.
+SAMPLE_LINES = 10000
+
+# Maximum number of inputs to sample (spread evenly over the inputs).
+SAMPLE_INPUTS = 16
+
+# Keys with at least this fraction of the average partition's load in the
+# sample are assigned explicitly.
+HEAVY_FRACTION = 0.05
+
+
+def key_of(line):
+   '''Return the key of QUACreduce line line as hashed by ``hashsplit``,
+      i.e., without the newline if there is no value. E.g.:
+
+      >>> [key_of(i) for i in (b'a\\tb\\n', b'a\\n', b'a\\t\\n')]
+      [b'a', b'a', b'a']'''
+   (key, tab, _) = line.partition(b'\t')
+   if (not tab):
+      key = line[:-1]
+   return key
+
+def loads_of(weights, nparts, pmap):
+   '''Return the load of each of nparts partitions given key weights (see
+      plan()) and partition map pmap. E.g.:
+
+      >>> w = { b'the': 50, b'z': 10, b'rt': 8, b'q': 2, b'bb': 1 }
+      >>> loads_of(w, 3, {})
+      [10, 60, 1]
+      >>> loads_of(w, 3, { b'the': 0, b'z': 1, b'rt': 2, b'q': 2 })
+      [50, 10, 11]'''
+   loads = [0] * nparts
+   for (k, w) in weights.items():
+      loads[partition_of(k, nparts, pmap)] += w
+   return loads
+
+def map_read(filename):
+   '''Return the partition map in file filename as a dict. E.g.:
+
+      >>> import tempfile
+      >>> tmp = tempfile.mkdtemp()
+      >>> map_write({ b'the': 1, b'rt': 0 }, tmp + '/m')
+      >>> open(tmp + '/m', 'rb').read()
+      b'rt\\t0\\nthe\\t1\\n'
+      >>> sorted(map_read(tmp + '/m').items())
+      [(b'rt', 0), (b'the', 1)]
+      >>> shutil.rmtree(tmp)'''
+   pmap = dict()
+   with io.open(filename, 'rb') as fp:
+      for line in fp:
+         (key, _, part) = line.rpartition(b'\t')
+         pmap[key] = int(part)
+   return pmap
+
+def map_write(pmap, filename):
+   'Write partition map pmap to file filename, sorted by key.'
+   with io.open(filename, 'wb') as fp:
+      for (key, part) in sorted(pmap.items()):
+         fp.write(b'%s\t%d\n' % (key, part))
+
+def partition_of(key, nparts, pmap):
+   '''Return the partition of key: from partition map pmap if it's there,
+      otherwise by hash. E.g.:
+
+      >>> partition_of(b'b', 240, {})
+      37
+      >>> partition_of(b'b', 240, { b'b': 3 })
+      3'''
+   part = pmap.get(key)
+   if (part is None):
+      part = hash_.of(key) % nparts
+   return part
+
+def plan(weights, nparts):
+   '''Given weights, a dict mapping keys to their load (e.g., bytes of map
+      output) in a sample, return a pair: a partition map for nparts
+      partitions and the resulting estimated load of each partition. E.g.,
+      with one dominant key (hashing alone would put the two heaviest keys
+      in the same partition; see loads_of()):
+
+      >>> w = { b'the': 50, b'z': 10, b'rt': 8, b'q': 2, b'bb': 1 }
+      >>> (pmap, loads) = plan(w, 3)
+      >>> sorted(pmap.items())
+      [(b'q', 2), (b'rt', 2), (b'the', 0), (b'z', 1)]
+      >>> loads
+      [50, 10, 11]
+      >>> plan(w, 1)
+      ({}, [71])
+      >>> plan({}, 2)
+      ({}, [0, 0])'''
+   loads = [0] * nparts
+   if (nparts == 1):
+      loads[0] = sum(weights.values())
+      return (dict(), loads)
+   threshold = HEAVY_FRACTION * sum(weights.values()) / nparts
+   heavy = sorted(((w, k) for (k, w) in weights.items() if w >= threshold),
+                  key=lambda wk: (-wk[0], wk[1]))
+   heavy_keys = set(k for (_, k) in heavy)
+   for (k, w) in weights.items():
+      if (k not in heavy_keys):
+         loads[hash_.of(k) % nparts] += w
+   pmap = dict()
+   for (w, k) in heavy:
+      part = min(range(nparts), key=lambda i: loads[i])
+      pmap[k] = part
+      loads[part] += w
+   return (pmap, loads)
+
+def sample(fp):
+   '''Return a dict mapping each key in the QUACreduce lines in iterable fp
+      to the total bytes of its lines. E.g.:
+
+      >>> sorted(sample([b'a\\tx\\n', b'b\\n', b'a\\tyy\\n']).items())
+      [(b'a', 9), (b'b', 2)]'''
+   weights = collections.Counter()
+   for line in fp:
+      weights[key_of(line)] += len(line)
+   return weights
+
+def sample_inputs(inputs):
+   '''Return the inputs to sample: at most SAMPLE_INPUTS of them, spread
+      evenly. E.g.:
+
+      >>> sample_inputs(list(range(5)))
+      [0, 1, 2, 3, 4]
+      >>> sample_inputs(list(range(40)))
+      [0, 2, 5, 7, 10, 12, 15, 17, 20, 22, 25, 27, 30, 32, 35, 37]'''
+   if (len(inputs) <= SAMPLE_INPUTS):
+      return list(inputs)
+   return [inputs[i * len(inputs) // SAMPLE_INPUTS]
+           for i in range(SAMPLE_INPUTS)]
+
+
+testable.register('')
@@ -0,0 +1,244 @@
+'''External sort of QUACreduce map output, for reducers that sort their own
+   input rather than reading it from ``sort``.
+
+   Lines are compared by key only (the bytes before the first tab), so the
+   opaque values are never examined, and the sort is stable: lines with
+   equal keys come out in input order, as with ``sort -s -k1,1``. Input that
+   doesn't fit in memory is sorted in runs which are spilled to temporary
+   files, compressed with a fast setting since the runs are written and read
+   once each. The runs are then merged lazily, straight into the reducer,
+   without writing a final sorted file. Whenever fan-in runs of the same
+   length accumulate, they are merged into one longer (spilled) run, so the
+   number of open files grows only with the logarithm of the input size.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import gzip
+import heapq
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import psutil
+
+import testable
+
+
+# Maximum number of runs to merge at once (sort --batch-size). More runs than
+# this are merged in multiple passes.
+FAN_IN = 64
+
+# gzip compression level of spilled runs. Level 1 is several times faster
+# than the default and still compresses base64 map output well.
+SPILL_COMPRESSLEVEL = 1
+
+# Number of lines timed() fetches at a time. Timing each line separately would
+# slow the merge noticeably.
+TIMED_BATCH = 4096
+
+# Units understood by size_parse(), which are those of sort -S.
+SIZE_UNITS = { 'b': 1,
+               'K': 2**10,
+               'M': 2**20,
+               'G': 2**30,
+               'T': 2**40 }
+
+
+def key_of(line):
+   '''Return the key of QUACreduce line line, for sorting. Note that this
+      includes the trailing newline for lines with no value; that's OK
+      because the reducers group with the same function.'''
+   return line.partition(b'\t')[0]
+
+def merge(runs, sortdir, fan_in=FAN_IN):
+   '''Return an iterator which merges the sorted iterables runs, stably (ties
+      are resolved in favor of earlier runs). If there are more than fan_in
+      runs, merge consecutive groups of them into runs spilled to sortdir
+      until there are few enough. E.g.:
+
+      >>> tmp = tempfile.mkdtemp()
+      >>> runs = [[b'a\\t1\\n', b'c\\t1\\n'], [b'b\\t2\\n'], [b'a\\t3\\n']]
+      >>> list(merge(runs, tmp))
+      [b'a\\t1\\n', b'a\\t3\\n', b'b\\t2\\n', b'c\\t1\\n']
+      >>> list(merge(runs, tmp, fan_in=2))
+      [b'a\\t1\\n', b'a\\t3\\n', b'b\\t2\\n', b'c\\t1\\n']
+      >>> os.rmdir(tmp)'''
+   assert (fan_in >= 2)
+   # heapq.merge() prefers earlier iterables on ties, so the merge is stable
+   # as long as the runs stay in order.
+   while (len(runs) > fan_in):
+      runs = [run_spill(heapq.merge(*runs[i:i + fan_in], key=key_of),
+                        sortdir)
+              for i in range(0, len(runs), fan_in)]
+   if (len(runs) == 1):
+      return iter(runs[0])
+   return heapq.merge(*runs, key=key_of)
+
+def file_lines(filename):
+   '''Generator which yields the lines of file filename, which is opened on
+      the first iteration and closed when done.'''
+   with io.open(filename, 'rb') as fp:
+      yield from fp
+
+def run_read(fp):
+   '''Generator which yields the lines of open run file fp, closing it when
+      done.'''
+   with fp, gzip.GzipFile(fileobj=fp, mode='rb') as gz:
+      yield from gz
+
+def run_spill(lines, sortdir):
+   '''Write the iterable lines, which must already be sorted, to a compressed
+      anonymous temporary file in sortdir. Return an iterator over the lines
+      of that file, which closes it when exhausted.'''
+   fp = tempfile.TemporaryFile(dir=sortdir)
+   with gzip.GzipFile(fileobj=fp, mode='wb',
+                      compresslevel=SPILL_COMPRESSLEVEL) as gz:
+      gz.writelines(lines)
+   fp.seek(0)
+   return run_read(fp)
+
+def size_parse(text):
+   '''Convert a ``sort -S`` memory size to bytes. E.g.:
+
+      >>> size_parse('64M')
+      67108864
+      >>> size_parse('2b')
+      2
+      >>> size_parse('1')
+      1024
+      >>> 0 < size_parse('10%') < psutil.virtual_memory().total
+      True
+      >>> size_parse('64Q')
+      Traceback (most recent call last):
+        ...
+      ValueError: invalid literal for int() with base 10: '64Q'
+      '''
+   if (text.endswith('%')):
+      return psutil.virtual_memory().total * int(text[:-1]) // 100
+   elif (text[-1:] in SIZE_UNITS):
+      return int(text[:-1]) * SIZE_UNITS[text[-1]]
+   else:
+      return int(text) * SIZE_UNITS['K']
+
+def sorted_lines(filenames, sortdir, sortmem, fan_in=FAN_IN, presorted=(),
+                 compressed=False):
+   '''Return an iterator over the lines in files filenames, stably sorted by
+      key. If there are more than sortmem bytes, spill sorted runs to sortdir
+      and merge them. Files in presorted are already sorted; they are merged
+      in as-is, ahead of filenames. If compressed, filenames (but not
+      presorted) are gzipped. (Note that Python lists of lines have
+      considerable overhead, so actual memory use is a small multiple of
+      sortmem.) Spilled runs are merged fan_in at a time as they accumulate,
+      so few files are open at once, however large the input. E.g.:
+
+      >>> tmp = tempfile.mkdtemp()
+      >>> open(tmp + '/a', 'wb').write(b'b\\t1\\na\\t2\\nc\\n')
+      10
+      >>> open(tmp + '/b', 'wb').write(b'b\\t3\\na\\t4\\n')
+      8
+      >>> open(tmp + '/s', 'wb').write(b'a\\t0\\nd\\t0\\n')
+      8
+      >>> ab = [tmp + '/a', tmp + '/b']
+      >>> list(sorted_lines(ab, tmp, 1024))
+      [b'a\\t2\\n', b'a\\t4\\n', b'b\\t1\\n', b'b\\t3\\n', b'c\\n']
+      >>> list(sorted_lines(ab, tmp, 8))
+      [b'a\\t2\\n', b'a\\t4\\n', b'b\\t1\\n', b'b\\t3\\n', b'c\\n']
+      >>> list(sorted_lines(ab, tmp, 4, fan_in=2))
+      [b'a\\t2\\n', b'a\\t4\\n', b'b\\t1\\n', b'b\\t3\\n', b'c\\n']
+      >>> list(sorted_lines(ab, tmp, 8, presorted=[tmp + '/s']))
+      [b'a\\t0\\n', b'a\\t2\\n', b'a\\t4\\n', b'b\\t1\\n', b'b\\t3\\n', b'c\\n', b'd\\t0\\n']
+      >>> with gzip.open(tmp + '/z', 'wb') as fp: fp.write(b'b\\t5\\na\\t6\\n')
+      8
+      >>> list(sorted_lines([tmp + '/z'], tmp, 8, compressed=True))
+      [b'a\\t6\\n', b'b\\t5\\n']
+      >>> sorted(os.listdir(tmp))
+      ['a', 'b', 's', 'z']
+
+      Open files stay bounded even with many runs, and are all closed once
+      the output has been read:
+
+      >>> open(tmp + '/m', 'wb').write(b''.join(b'%d\\t\\n' % (i % 7)
+      ...                                      for i in range(100)))
+      300
+      >>> fd_ct = psutil.Process().num_fds()
+      >>> lines = sorted_lines([tmp + '/m'], tmp, 1, fan_in=4)
+      >>> psutil.Process().num_fds() - fd_ct <= 4 * 4
+      True
+      >>> len(list(lines))
+      100
+      >>> psutil.Process().num_fds() - fd_ct
+      0
+      >>> shutil.rmtree(tmp)'''
+   runs = [file_lines(i) for i in presorted]
+   # Spilled runs and their levels (0 for runs sorted in memory, n + 1 for
+   # runs merged from level n). Levels never increase along the list, and
+   # there are fewer than fan_in of each.
+   spilled = list()
+   buf = list()
+   buf_size = 0
+   open_ = gzip.open if compressed else io.open
+   for filename in filenames:
+      with open_(filename, 'rb') as fp:
+         for line in fp:
+            buf.append(line)
+            buf_size += len(line)
+            if (buf_size >= sortmem):
+               buf.sort(key=key_of)
+               spilled.append((0, run_spill(buf, sortdir)))
+               buf = list()
+               buf_size = 0
+               while (len(spilled) >= fan_in
+                      and spilled[-fan_in][0] == spilled[-1][0]):
+                  level = spilled[-1][0]
+                  group = [r for (_, r) in spilled[-fan_in:]]
+                  del spilled[-fan_in:]
+                  spilled.append((level + 1,
+                                  run_spill(heapq.merge(*group, key=key_of),
+                                            sortdir)))
+   buf.sort(key=key_of)
+   runs.extend(r for (_, r) in spilled)
+   if (len(runs) == 0):
+      return iter(buf)
+   runs.append(buf)
+   return merge(runs, sortdir, fan_in)
+
+def timed(lines, stats, key, batch=TIMED_BATCH):
+   '''Generator which yields the items in iterable lines, adding the time
+      spent getting them to stats[key]. This is for measuring lazy merges,
+      whose cost is otherwise hidden in the consumer's. E.g.:
+
+      >>> stats = { 'sort_time': 1.0 }
+      >>> list(timed(iter([b'a\\n', b'b\\n', b'c\\n']), stats, 'sort_time', 2))
+      [b'a\\n', b'b\\n', b'c\\n']
+      >>> stats['sort_time'] >= 1.0
+      True'''
+   lines = iter(lines)
+   while True:
+      start = time.time()
+      buf = list(itertools.islice(lines, batch))
+      stats[key] += time.time() - start
+      if (len(buf) == 0):
+         return
+      yield from buf
+
+def tee(lines, filename):
+   '''Generator which yields the items in iterable lines, also writing them to
+      file filename. E.g.:
+
+      >>> tmp = tempfile.mkdtemp()
+      >>> list(tee([b'a\\n', b'b\\n'], tmp + '/t'))
+      [b'a\\n', b'b\\n']
+      >>> open(tmp + '/t', 'rb').read()
+      b'a\\nb\\n'
+      >>> shutil.rmtree(tmp)'''
+   with io.open(filename, 'wb') as fp:
+      for line in lines:
+         fp.write(line)
+         yield line
+
+
+testable.register('')
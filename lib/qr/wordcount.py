@@ -6,11 +6,24 @@
 
 from . import base
 
-class Job(base.Line_Input_Job, base.Line_Output_Job):
+class Job(base.Combine_Job, base.Line_Input_Job, base.Line_Output_Job):
 
    def map(self, line):
       for word in line.split():
-         yield (word, None)
+         yield (word, 1)
 
-   def reduce(self, word, nones):
-      yield '%d %s' % (len(list(nones)) * self.params['factor'], word)
+   def combine(self, word, counts):
+      yield sum(counts)
+
+   def reduce(self, word, counts):
+      yield '%d %s' % (sum(counts) * self.params['factor'], word)
+
+
+class Partition_Job(base.Combine_Job, base.Partition_Output_Job,
+                    base.Line_Input_Job, base.Line_Output_Job):
+
+   'Same, but partitions map output in-process rather than with hashsplit.'
+
+   map = Job.map
+   combine = Job.combine
+   reduce = Job.reduce
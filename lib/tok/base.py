@@ -7,39 +7,73 @@
 
 
 from abc import ABCMeta, abstractmethod
+import hashlib
 import itertools
+import multiprocessing
 import operator
 from pprint import pprint
 
+import multicore
 import testable
+import u
+
+
+# Multiplier for the rolling n-gram hash (the 64-bit FNV prime).
+HASH_MULT = 0x100000001b3
+HASH_MASK = 2**64 - 1
+
+# Default number of texts sent to a worker at a time by tokenize_many().
+MANY_CHUNKSIZE = 1000
+
+# Tokenizer used by the current worker process in tokenize_many().
+pool_tzer = None
 
 
 class Tzer(object, metaclass=ABCMeta):
-   def __init__(self, ngram):
+
+   '''Base class for tokenizers. tokenize() returns a list of unigrams
+      followed by n-grams up to length ngram, as strings joined by spaces.
+
+      If hashed, tokenize() instead returns the 64-bit hash of each of these
+      (see hash_token() and hash_combine()). N-gram hashes are computed from
+      the unigram hashes, so no n-gram strings are built. If hash_names is
+      also true, the dictionary hash_names maps each hash seen to its
+      string, for reporting.'''
+
+   def __init__(self, ngram, hashed=False, hash_names=False):
       if (ngram < 1):
          raise ValueError('ngram must be >= 1, but %d given' % (ngram))
       self.ngram = ngram
+      self.hashed = hashed
+      self.hash_names = dict() if (hashed and hash_names) else None
 
    def __str__(self):
       return '%s.%s;%d' % (self.__class__.__module__, self.__class__.__name__,
                            self.ngram)
 
+   def ngrams_join(self, unigrams):
+      'Return unigrams followed by their n-grams, as strings.'
+      # The basic approach here:
+      # 1. Find the unigram sequence u and copy this to the output.
+      # 2. Bigrams: append itertools.izip(u, u[1:])
+      # 3. Trigrams: append itertools.izip(u, u[1:], u[2:])
+      # 4. etc.
+      tokens = list(unigrams)
+      sources = [unigrams]
+      for i in range(1, self.ngram):
+         sources.append(unigrams[i:])
+         tokens += (' '.join(j) for j in zip(*sources))
+      return tokens
+
    def tokenize(self, s):
       if (s is None):
          return []
       elif (isinstance(s, str)):
-         # The basic approach here:
-         # 1. Find the unigram sequence u and copy this to the output.
-         # 2. Bigrams: append itertools.izip(u, u[1:])
-         # 3. Trigrams: append itertools.izip(u, u[1:], u[2:])
-         # 4. etc.
          unigrams = self.tokenize_real(s)
-         tokens = list(unigrams)
-         sources = [unigrams]
-         for i in range(1, self.ngram):
-            sources.append(unigrams[i:])
-            tokens += (' '.join(j) for j in zip(*sources))
-         return tokens
+         if (self.hashed):
+            return self.tokenize_hashed(unigrams)
+         else:
+            return self.ngrams_join(unigrams)
       else:
          raise TypeError('expected unicode or None, got %s' % (type(s)))
 
@@ -57,12 +91,91 @@ class Tzer(object, metaclass=ABCMeta):
          result += [(key, i) for i in tokens]
       return result
 
+   def tokenize_hashed(self, unigrams):
+      '''Return the hashes of unigrams and their n-grams, in the same order
+         as tokenize(). The hash of the n-gram starting at unigram i is that
+         of the (n-1)-gram starting at i, combined with the hash of unigram
+         i+n-1.'''
+      hashes = [hash_token(t) for t in unigrams]
+      tokens = list(hashes)
+      prev = hashes
+      for i in range(1, self.ngram):
+         prev = [hash_combine(p, h) for (p, h) in zip(prev, hashes[i:])]
+         tokens += prev
+      if (self.hash_names is not None):
+         self.hash_names.update(zip(tokens, self.ngrams_join(unigrams)))
+      return tokens
+
+   def tokenize_many(self, texts, processes=None, chunksize=MANY_CHUNKSIZE):
+      '''Tokenize each string in iterable texts and return a list of the
+         results, in the same order. The work is spread over processes
+         worker processes (default multicore.core_ct); each worker gets its
+         own copy of the tokenizer once, at startup, and reuses it (and any
+         break iterators or segmenters it holds) for chunks of chunksize
+         texts. If hash_names is enabled, names seen by the workers are
+         collected here. E.g.:
+
+         >>> t = Whitespace(2)
+         >>> t.tokenize_many(['a b', None, 'C'], processes=2, chunksize=1)
+         [['a', 'b', 'a b'], [], ['c']]
+         >>> t = Whitespace(1, hashed=True, hash_names=True)
+         >>> hs = t.tokenize_many(['a b', 'c'] * 3, processes=2, chunksize=2)
+         >>> [[t.hash_names[h] for h in i] for i in hs[:2]]
+         [['a', 'b'], ['c']]
+         >>> Whitespace(1).tokenize_many([])
+         []'''
+      if (processes is None):
+         processes = multicore.core_ct
+      if (processes <= 1):
+         tokenize = self.tokenize
+         return [tokenize(s) for s in texts]
+      result = list()
+      with multiprocessing.Pool(processes, pool_init, (self,)) as pool:
+         for (tokens, names) in pool.imap(pool_tokenize,
+                                          u.groupn(texts, chunksize)):
+            result.extend(tokens)
+            if (self.hash_names is not None):
+               self.hash_names.update(names)
+      return result
+
    @abstractmethod
    def tokenize_real(self, s):
       '''Given a unicode s, tokenize it and return the tokenization as a
          sequence of tokens. s is guaranteed to be a unicode object.'''
 
 
+def hash_combine(a, b):
+   '''Return the hash of the n-gram with prefix hash a followed by a token
+      with hash b. E.g., this is the hash of the bigram "a b":
+
+      >>> hash_combine(hash_token('a'), hash_token('b'))
+      7069440100192634692'''
+   return (a * HASH_MULT + b) & HASH_MASK
+
+def pool_init(tzer):
+   global pool_tzer
+   pool_tzer = tzer
+
+def pool_tokenize(texts):
+   '''Tokenize texts with the tokenizer of the current tokenize_many() worker
+      and return a pair: the list of results and the names of hashes seen
+      (or None).'''
+   tokenize = pool_tzer.tokenize
+   tokens = [tokenize(s) for s in texts]
+   names = pool_tzer.hash_names
+   if (names is not None):
+      pool_tzer.hash_names = dict()
+   return (tokens, names)
+
+def hash_token(token):
+   '''Return the 64-bit hash of string token. E.g.:
+
+      >>> hash_token('a')
+      3405396810240292928'''
+   return int.from_bytes(hashlib.blake2b(token.encode('utf8'),
+                                         digest_size=8).digest(), 'little')
+
+
 class Whitespace(Tzer):
    'Just split on whitespace and squash case.'
 
@@ -120,6 +233,21 @@ ValueError: ngram must be >= 1, but 0 given
 >>> Whitespace(3).tokenize('a b c')
 ['a', 'b', 'c', 'a b', 'b c', 'a b c']
 
+# Hashed ngrams
+>>> t = Whitespace(3, hashed=True, hash_names=True)
+>>> hs = t.tokenize('a b c')
+>>> [t.hash_names[h] for h in hs]
+['a', 'b', 'c', 'a b', 'b c', 'a b c']
+>>> hs[0] == hash_token('a')
+True
+>>> hs[5] == hash_combine(hash_combine(hash_token('a'), hash_token('b')),
+...                       hash_token('c'))
+True
+>>> Whitespace(2, hashed=True).hash_names is None
+True
+>>> Whitespace(2, hashed=True).tokenize('')
+[]
+
 ''')
 
 def test_interactive():
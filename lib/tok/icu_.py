@@ -82,16 +82,32 @@ class ICU(base.Tzer):
       True
       >>> ICU(1).tokenize(base.T_FR) == base.T_FR_TOKS
       True
+      >>> (ICU(1).tokenize_many([base.T_EN, base.T_FR], processes=2)
+      ...  == [base.T_EN_TOKS_ICU, base.T_FR_TOKS])
+      True
       '''
 
    def __init__(self, ngram, locale=icu.Locale.getDefault(),
-                must_have_alnum=True):
+                must_have_alnum=True, **kwargs):
       #assert (multicore.core_ct == 1)  # ICU hangs under multicore
-      base.Tzer.__init__(self, ngram)
+      base.Tzer.__init__(self, ngram, **kwargs)
       self.locale = locale
       self.iterator = icu.BreakIterator.createWordInstance(self.locale)
       self.must_have_alnum = must_have_alnum
 
+   def __getstate__(self):
+      # ICU objects can't be pickled (e.g., for tokenize_many()), so save the
+      # locale by name and make a new break iterator when unpickling.
+      state = self.__dict__.copy()
+      state['locale'] = self.locale.getName()
+      del state['iterator']
+      return state
+
+   def __setstate__(self, state):
+      self.__dict__.update(state)
+      self.locale = icu.Locale(self.locale)
+      self.iterator = icu.BreakIterator.createWordInstance(self.locale)
+
    def is_word(self, s):
       '''A word is: (a) not empty, (b) not a space, (c) if must_have_alnum is
          True, contains at least one alpha-numeric.
@@ -130,8 +146,8 @@ class Tiny_ICU(base.Tzer):
        >>> Tiny_ICU(1).tokenize(base.T_PUNCT) == base.T_PUNCT_TOKS
        True'''
 
-   def __init__(self, ngram):
-      base.Tzer.__init__(self, ngram)
+   def __init__(self, ngram, **kwargs):
+      base.Tzer.__init__(self, ngram, **kwargs)
       self.tiny = tiny.Tzer(ngram)
       self.icu = ICU(ngram)
 
@@ -1,8 +1,5 @@
 # Copyright (c) Los Alamos National Security, LLC, and others.
 
-import itertools
-import operator
-
 import unicodedata2
 
 from . import base
@@ -55,17 +52,15 @@ class UP_Tiny(base.Tzer):
                           'Common', 'Inherited'))
    JP_SCRIPTS = set(('Han', 'Hiragana', 'Katakana'))
 
-   def __init__(self, ngram):
-      base.Tzer.__init__(self, ngram)
+   def __init__(self, ngram, **kwargs):
+      base.Tzer.__init__(self, ngram, **kwargs)
       self.tiny = tiny.Tzer(ngram)
 
    def tokenize_real(self, text):
-      chars = ((unicodedata2.script_cat(c), c) for c in text)
       tokens = list()
-      for (key, group) in itertools.groupby(chars, operator.itemgetter(0)):
-         if (key[1][0] == 'L' and key[0] not in self.DISCARD_SCRIPTS):
-            cand = ''.join((c[1] for c in group))
-            if (key[0] in self.JP_SCRIPTS):
+      for (script, cat, cand) in unicodedata2.script_runs(text):
+         if (cat[0] == 'L' and script not in self.DISCARD_SCRIPTS):
+            if (script in self.JP_SCRIPTS):
                tokens.extend(self.tiny.tokenize(cand))
             else:
                tokens.append(cand.lower())
@@ -93,5 +88,10 @@ True
 True
 >>> UP_Tiny(1).tokenize(base.T_WEIRD) == base.T_WEIRD_TOKS
 True
+>>> UP_Tiny(1).tokenize('ab\u0e01\u0e02 c\u0301d ABC')
+['ab', 'c', 'd', 'abc']
+>>> (UP_Tiny(1, hashed=True).tokenize(base.T_JP)
+...  == [base.hash_token(t) for t in base.T_JP_TOKS])
+True
 
 ''')
@@ -0,0 +1,231 @@
+'''Selection of the K highest-scoring items from a large, sharded stream.
+
+   :class:`u.Priority_Queue` pushes every item onto a heap, which means a
+   Python-level comparison per item and a heap operation for every item that
+   beats the current minimum. When choosing a few thousand candidates from
+   hundreds of millions of scored time series, that dominates. A
+   :class:`Top_K` instead keeps its items sorted in NumPy arrays and a floor
+   (the lowest score kept once full): items at or below the floor are
+   rejected with one comparison, or in bulk with :meth:`Top_K.add_many()`,
+   and the rest are buffered and trimmed back to K with
+   :func:`numpy.partition` once K have accumulated.
+
+   A typical use is to build one :class:`Top_K` per shard, in parallel, and
+   then combine them with :func:`merge_all()`. Partial results pickle
+   compactly, so they can be returned from worker processes (e.g.,
+   :func:`multicore.do()`) or emitted as map output and merged by a QUACreduce
+   reducer::
+
+      def map(self, shard):
+         t = topk.Top_K(self.params['k'])
+         t.add_many(scores_of(shard), names_of(shard))
+         yield ('top', t)
+
+      def reduce(self, key, partials):
+         yield (key, topk.merge_all(partials))
+
+   Scores are floats; NaN scores are ignored, as in
+   :class:`u.Priority_Queue`. Among equal scores, the item added first (or
+   from the earlier partial result, when merging) wins.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import heapq
+import itertools
+
+import numpy as np
+
+import testable
+
+
+class Top_K(object):
+
+   '''Keep the k highest-scoring items added. E.g.:
+
+      >>> t = Top_K(3)
+      >>> t.add(1, 'a')
+      >>> t.add(3, 'b')
+      >>> t.add(float('nan'), 'x')
+      >>> t.add_many(np.array([2, 0, 4, 3]), ['c', 'd', 'e', 'f'])
+      >>> t
+      Top_K(3, [(4.0, 'e'), (3.0, 'b'), (3.0, 'f')])
+      >>> len(t)
+      3
+      >>> t.floor
+      3.0
+      >>> list(t.values())
+      ['e', 'b', 'f']
+      >>> Top_K(0)
+      Traceback (most recent call last):
+        ...
+      ValueError: k 0 is not greater than zero
+
+      Only the selected items of values are accessed, so it can be a lazy
+      sequence:
+
+      >>> class Noisy(object):
+      ...    def __getitem__(self, i):
+      ...       print('getting', i)
+      ...       return i
+      >>> t.add_many([1, 5, 2, 6], Noisy())
+      getting 1
+      getting 3
+      >>> list(t.priorities())
+      [6.0, 5.0, 4.0]'''
+
+   def __init__(self, k):
+      if (k <= 0):
+         raise ValueError('k %d is not greater than zero' % (k))
+      self.k = k
+      # Kept items, sorted by decreasing score.
+      self.scores = np.empty(0)
+      self.vals = list()
+      # Items added but not yet compared with the kept ones.
+      self.pend_scores = list()
+      self.pend_vals = list()
+      # Once full, scores at or below this can't get in.
+      self.floor = -np.inf
+
+   def __getstate__(self):
+      self.compact()
+      return { 'k': self.k,
+               'scores': self.scores,
+               'vals': self.vals }
+
+   def __len__(self):
+      self.compact()
+      return len(self.scores)
+
+   def __repr__(self):
+      return 'Top_K(%d, %r)' % (self.k, list(self.items()))
+
+   def __setstate__(self, state):
+      self.__init__(state['k'])
+      self.scores = state['scores']
+      self.vals = state['vals']
+      self.floor_update()
+
+   def add(self, score, value):
+      # NaN fails this test, so NaN scores are dropped.
+      if (score > self.floor):
+         self.pend_scores.append(score)
+         self.pend_vals.append(value)
+         if (len(self.pend_scores) >= self.k):
+            self.compact()
+
+   def add_many(self, scores, values):
+      '''Add the items with scores scores (an array) and values values (a
+         sequence of the same length).'''
+      scores = np.asarray(scores, dtype=np.float64)
+      idx = np.flatnonzero(scores > self.floor)
+      if (len(idx) > self.k):
+         idx = idx[best_k(scores[idx], self.k)]
+      self.pend_scores.extend(scores[idx].tolist())
+      self.pend_vals.extend(values[i] for i in idx)
+      if (len(self.pend_scores) >= self.k):
+         self.compact()
+
+   def compact(self):
+      'Merge pending items into the kept ones, keeping the best k.'
+      if (len(self.pend_scores) == 0):
+         return
+      scores = np.concatenate((self.scores, self.pend_scores))
+      vals = self.vals + self.pend_vals
+      keep = best_k(scores, self.k)
+      # Sort by decreasing score, then by order added.
+      keep = keep[np.lexsort((keep, -scores[keep]))]
+      self.scores = scores[keep]
+      self.vals = [vals[i] for i in keep]
+      self.pend_scores = list()
+      self.pend_vals = list()
+      self.floor_update()
+
+   def floor_update(self):
+      if (len(self.scores) >= self.k):
+         self.floor = float(self.scores[-1])
+
+   def items(self):
+      'Return an iterator of (score, value) pairs, best first.'
+      self.compact()
+      return zip(self.scores.tolist(), self.vals)
+
+   def merge(self, other):
+      '''Return a new Top_K containing the best items of myself and other,
+         which must have the same k. E.g.:
+
+         >>> a = Top_K(2)
+         >>> a.add_many([1, 3], ['a', 'b'])
+         >>> b = Top_K(2)
+         >>> b.add_many([3, 2], ['c', 'd'])
+         >>> a.merge(b)
+         Top_K(2, [(3.0, 'b'), (3.0, 'c')])
+         >>> a.merge(Top_K(3))
+         Traceback (most recent call last):
+           ...
+         ValueError: cannot merge Top_K with different k'''
+      if (self.k != other.k):
+         raise ValueError('cannot merge Top_K with different k')
+      return merge_all([self, other])
+
+   def priorities(self):
+      return (s for (s, v) in self.items())
+
+   def values(self):
+      return (v for (s, v) in self.items())
+
+
+def best_k(scores, k):
+   '''Return the indices of the k highest of array scores, in increasing
+      order; among equal scores, earlier ones are chosen. E.g.:
+
+      >>> best_k(np.array([1, 3, 2, 3, 0]), 2)
+      array([1, 3])
+      >>> best_k(np.array([1, 3, 2, 3, 3]), 2)
+      array([1, 3])
+      >>> best_k(np.array([1, 2]), 3)
+      array([0, 1])'''
+   if (len(scores) <= k):
+      return np.arange(len(scores))
+   kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+   above = np.flatnonzero(scores > kth)
+   ties = np.flatnonzero(scores == kth)[:k - len(above)]
+   return np.sort(np.concatenate((above, ties)))
+
+def merge_all(tops, k=None):
+   '''Return a new Top_K with the best k items in the Top_K objects tops
+      (default k is that of the first). Each is already sorted, so this is a
+      k-way merge which stops after k items. E.g.:
+
+      >>> import pickle
+      >>> parts = list()
+      >>> for shard in range(4):
+      ...    t = Top_K(3)
+      ...    t.add_many(np.arange(shard, 40, 4), list(range(shard, 40, 4)))
+      ...    parts.append(pickle.loads(pickle.dumps(t)))
+      >>> merge_all(parts)
+      Top_K(3, [(39.0, 39), (38.0, 38), (37.0, 37)])
+      >>> merge_all(parts, k=5)
+      Top_K(5, [(39.0, 39), (38.0, 38), (37.0, 37), (36.0, 36), (35.0, 35)])
+      >>> merge_all([])
+      Traceback (most recent call last):
+        ...
+      ValueError: nothing to merge'''
+   tops = list(tops)
+   if (len(tops) == 0):
+      raise ValueError('nothing to merge')
+   if (k is None):
+      k = tops[0].k
+   # Sort keys are (-score, partial, position), which are unique, so values
+   # are never compared.
+   streams = [((-s, i, j, v) for (j, (s, v)) in enumerate(t.items()))
+              for (i, t) in enumerate(tops)]
+   best = list(itertools.islice(heapq.merge(*streams), k))
+   new = Top_K(k)
+   new.scores = np.array([-s for (s, _, _, _) in best], dtype=np.float64)
+   new.vals = [v for (_, _, _, v) in best]
+   new.floor_update()
+   return new
+
+
+testable.register('')
@@ -6,23 +6,44 @@
 
 from datetime import date, datetime
 import dateutil.parser
-import html.parser
+import html
+import io
 from pprint import pprint
 import re
 
 from django.contrib.gis import geos
+import numpy as np
 import ujson as json
 
 import testable
 import time_
+import tok.base
 import tsv_glue
 import u
 
 
-HTML_PARSER = html.parser.HTMLParser()
 NON_ALPHANUMERICS_RE = re.compile(r'[\W_]+')
 WHITESPACES_RE = re.compile(r'[\s\0]+')
 
+# Columns of the TSV representation (see to_list() and README).
+TSV_COLUMNS = ('id',
+               'created_at',
+               'text',
+               'user_screen_name',
+               'user_description',
+               'user_lang',
+               'user_location',
+               'user_time_zone',
+               'lon',
+               'lat',
+               'geom_src')
+# Columns read_columns() converts to arrays; the rest become lists of
+# strings (or None).
+TSV_ARRAY_DTYPES = { 'id': np.int64,
+                     'created_at': 'datetime64[s]',
+                     'lon': np.float64,
+                     'lat': np.float64 }
+
 
 class Nothing_To_Parse_Error(Exception):
    pass
@@ -84,11 +105,14 @@ def expected_count(date_, sample_rate):
    # calculations should be done at import time).
    raise ValueError("extrapolating to %s is too scary" % (date_))
 
-def from_json(text):
+def from_json(text, fields=None):
    # Skip lines containing nothing but whitespace and lines that contain just
    # a hexadecimal number. The latter arises when the tweet stream is using
    # "Transfer-Encoding: chunked" and the chunk delimeters made their way into
    # the output file (i.e., before issue #92 was fixed).
+   #
+   # If fields is given, only those attributes of tweets are extracted; the
+   # rest are None.
    if (re.search(r'^[0-9a-f\s]*$', text)):
       raise Nothing_To_Parse_Error()
    j = json.loads(text)  # raises ValueError on parse failure
@@ -101,7 +125,7 @@ def from_json(text):
    elif ('status_withheld' in j):
       return Status_Withheld.from_json(j)
    elif ('text' in j):
-      return Tweet.from_json(j)
+      return Tweet.from_json(j, fields)
    elif ('warning' in j):
       return Warning.from_json(j)
    else:
@@ -140,21 +164,25 @@ def text_clean(t):
       'A B C>D'
       >>> text_clean(u'null') is None
       True
+      >>> text_clean(u'A&B &amp;')
+      'A&B &'
 
       This is to ensure that all tweets play nicely with our TSV files and
       generally make parsing down the line easier.'''
-   # FIXME: This method uses an undocumented method in HTMLParser, unescape().
-   # See <http://stackoverflow.com/questions/2087370>.
    if (t is None or t == 'null'):
       return None
    else:
-      try:
-         t = HTML_PARSER.unescape(t)
-      except Exception as x:
-         # don't print the offending text because it could be arbitrary binary
-         # goop, but that makes the problem hard to diagnose...
-         u.l.warning('exception while HTML unescaping, will use None: %s' % (x))
-         return None
+      # Most strings have no entities, and checking is much cheaper than
+      # unescaping.
+      if ('&' in t):
+         try:
+            t = html.unescape(t)
+         except Exception as x:
+            # don't print the offending text because it could be arbitrary
+            # binary goop, but that makes the problem hard to diagnose...
+            u.l.warning('exception while HTML unescaping, will use None: %s'
+                        % (x))
+            return None
       t = WHITESPACES_RE.sub(' ', t)
       return t
 
@@ -177,7 +205,7 @@ class Reader(tsv_glue.Reader):
    'Like a tsv_glue.Reader, except it emits Tweet objects, not lists.'
 
    def __next__(self):
-      return Tweet.from_list(tsv_glue.Reader.next(self))
+      return Tweet.from_list(tsv_glue.Reader.__next__(self))
 
 
 class Tweet(object):
@@ -186,27 +214,49 @@ class Tweet(object):
    # these coordinates are almost certainly bogus. So, if you encounter a
    # tweet which really does have these coordinates, you are out of luck.
 
+   # The geotag is stored as coordinates and converted to a Point only when
+   # geom is first used, because making Points is slow and many consumers
+   # never look at it. Use coords to get the coordinates without a Point.
+   # Similarly, from_list() keeps the created_at string and parses it only
+   # when created_at is first used.
    __slots__ = ('tokens',
                 'id',
-                'created_at',
                 'text',
                 'user_screen_name',
                 'user_description',
                 'user_lang',
                 'user_location',
                 'user_time_zone',
-                'geom',
+                '_coords',
+                '_created_at',
+                '_created_at_raw',
+                '_geom',
                 'geom_src')
 
+   # Attributes compared by __eq__(), and available to extract from JSON.
+   ATTRS = ('tokens',
+            'id',
+            'created_at',
+            'text',
+            'user_screen_name',
+            'user_description',
+            'user_lang',
+            'user_location',
+            'user_time_zone',
+            'geom',
+            'geom_src')
+
    def __init__(self):
       self.tokens = None
+      self.created_at = None
+      self.geom = None
 
    def __eq__(self, other):
       try:
          if (self.__slots__ != other.__slots__): return False
       except AttributeError:
          return False
-      for attr in self.__slots__:
+      for attr in self.ATTRS:
          if (getattr(self, attr) != getattr(other, attr)): return False
       return True
 
@@ -229,39 +279,86 @@ class Tweet(object):
          # This hack guarantees that the returned time zone is a single token.
          return NON_ALPHANUMERICS_RE.sub('', self.user_time_zone)
 
+   @property
+   def coords(self):
+      'The geotag as a (longitude, latitude) tuple, or None.'
+      if (self._coords is not None):
+         return self._coords
+      elif (self._geom is not None):
+         return self._geom.coords
+      else:
+         return None
+
+   @property
+   def created_at(self):
+      if (self._created_at is None and self._created_at_raw is not None):
+         self._created_at = time_.iso8601utc_parse(self._created_at_raw)
+      return self._created_at
+
+   @created_at.setter
+   def created_at(self, created_at):
+      self._created_at = created_at
+      self._created_at_raw = None
+
    @property
    def day(self):
       'String representation of the created_at day.'
+      if (self._created_at_raw is not None):
+         return self._created_at_raw[:10]
       return self.created_at.strftime('%Y-%m-%d')
 
+   @property
+   def geom(self):
+      if (self._geom is None and self._coords is not None):
+         self._geom = geos.Point(self._coords, srid=u.WGS84_SRID)
+      return self._geom
+
+   @geom.setter
+   def geom(self, geom):
+      self._geom = geom
+      self._coords = None
+
    @classmethod
-   def from_json(class_, json):
+   def from_json(class_, json, fields=None):
+      '''Given decoded JSON, return the corresponding Tweet object. If fields
+         is given, set only those attributes and leave the rest None.'''
       o = class_()
+      if (fields is None):
+         fields = class_.ATTRS
+      user = json['user']
       # raw data
-      o.id = json['id']
-        # FIXME: This time parse routine is fairly slow (about half of the
-        # total time is spent parsing dates).
-      o.created_at = time_.twitter_timestamp_parse(json['created_at'])
-      o.text = text_clean(json['text'])
-      o.user_screen_name = text_clean(json['user']['screen_name'])
-      o.user_description = text_clean(json['user']['description'])
-      if ('lang' in json['user']):
-         o.user_lang = text_clean(json['user']['lang'])
+      o.id = json['id'] if ('id' in fields) else None
+      if ('created_at' in fields):
+         o.created_at = time_.twitter_timestamp_parse(json['created_at'])
       else:
-         o.user_lang = None
-      o.user_location = text_clean(json['user']['location'])
-      o.user_time_zone = text_clean(json['user']['time_zone'])
-      try:
-         o.geom = o.coords_to_point(json['coordinates']['coordinates'][0],
-                                    json['coordinates']['coordinates'][1])
-         o.geom_src = 'co'
-         assert (json['coordinates']['type'] == 'Point')
-      except (TypeError, KeyError):
-         # json['coordinates']:
-         # - isn't a dict if there's no geotag (TypeError)
-         # - may not exist at all in older tweets (KeyError)
-         o.geom = None
-         o.geom_src = None
+         o.created_at = None
+      for (attr, field) in (('text', None),
+                            ('user_screen_name', 'screen_name'),
+                            ('user_description', 'description'),
+                            ('user_lang', 'lang'),
+                            ('user_location', 'location'),
+                            ('user_time_zone', 'time_zone')):
+         if (attr not in fields):
+            setattr(o, attr, None)
+         elif (field is None):
+            setattr(o, attr, text_clean(json[attr]))
+         elif (field == 'lang' and 'lang' not in user):
+            setattr(o, attr, None)
+         else:
+            setattr(o, attr, text_clean(user[field]))
+      o.geom_src = None
+      if ('geom' in fields or 'geom_src' in fields):
+         try:
+            o.coords_set(json['coordinates']['coordinates'][0],
+                         json['coordinates']['coordinates'][1])
+            o.geom_src = 'co'
+            assert (json['coordinates']['type'] == 'Point')
+         except (TypeError, KeyError):
+            # json['coordinates']:
+            # - isn't a dict if there's no geotag (TypeError)
+            # - may not exist at all in older tweets (KeyError)
+            o.geom = None
+            o.geom_src = None
       return o
 
    @classmethod
@@ -283,21 +380,34 @@ class Tweet(object):
 
    @classmethod
    def from_list(class_, list_):
-      'Given a list representation, return the corresponding Tweet object.'
+      '''Given a list representation, return the corresponding Tweet object.
+         Note that the timestamp is not parsed until created_at is first
+         used, so an invalid one raises ValueError then, not here.'''
       # WARNING: Make sure this is consistent with to_list() and README.
       o = class_()
       o.id = int(list_[0])
-      o.created_at = time_.iso8601utc_parse(list_[1])  # FIXME: Slow? Issue #46
+      o._created_at_raw = list_[1]  # parsing is slow; issue #46
       o.text = list_[2]
       o.user_screen_name = list_[3]
       o.user_description = list_[4]
       o.user_lang = list_[5]
       o.user_location = list_[6]
       o.user_time_zone = list_[7]
-      o.geom = o.coords_to_point(list_[8], list_[9])
+      o.coords_set(list_[8], list_[9])
       o.geom_src = list_[10]
       return o
 
+   def coords_set(self, lon, lat):
+      '''Set the geotag to longitude lon and latitude lat, following the same
+         rules as coords_to_point(), but without making a Point yet.'''
+      if (lon is None or lat is None):
+         self.geom = None
+      else:
+         (lon, lat) = (float(lon), float(lat))
+         self.geom = None
+         if (not lon == lat == 0):
+            self._coords = (lon, lat)
+
    def coords_to_point(self, lon, lat):
       '''Given longitude and latitude, return a geos.Point object, or None if
          the coordinates are None or zero. lon and lat can be strings or
@@ -330,12 +440,15 @@ class Tweet(object):
       'Return a list representation of this object.'
       # WARNING: Make sure this is consistent with README and from_list()
       # FIXME: should this be a special method of some kind?
-      if (self.geom is None):
-         (lon, lat) = (None, None)
-      else:
-         (lon, lat) = self.geom.coords
+      (lon, lat) = self.coords or (None, None)
+      created_at = self._created_at_raw
+      if (created_at is None or created_at[10:11] != 'T'
+          or time_.ISO8601UTC_FAST.match(created_at) is None):
+         # not from from_list(), or not in our canonical format (which this
+         # normalizes, or raises ValueError if invalid)
+         created_at = self.created_at.isoformat()
       return [ self.id,
-               self.created_at.isoformat(),
+               created_at,
                self.text,
                self.user_screen_name,
                self.user_description,
@@ -349,19 +462,29 @@ class Tweet(object):
    def tokenize(self, tker, fields, unify):
       '''Tokenize given fields and set self.tokens to the resulting sequence.
          If not unify, then add a prefix to each token distinguishing which
-         field it came from. E.g.:
+         field it came from (for hashed tokenizers, the field is combined
+         into the hash as if it were a preceding token). E.g.:
 
          >>> import tok.base
          >>> tzer = tok.base.Whitespace(1)
          >>> sorted(T_TW_SIMPLE.tokenize(tzer, ['tx', 'tz'], False))
          ['tx a', 'tx b', 'tz g']
          >>> sorted(T_TW_SIMPLE.tokenize(tzer, ['tx', 'tz'], True))
-         ['a', 'b', 'g']'''
+         ['a', 'b', 'g']
+         >>> tzer = tok.base.Whitespace(1, hashed=True)
+         >>> bigrams = tok.base.Whitespace(2, hashed=True)
+         >>> (sorted(T_TW_SIMPLE.tokenize(tzer, ['tx'], False))
+         ...  == sorted([bigrams.tokenize('tx a')[-1],
+         ...             bigrams.tokenize('tx b')[-1]]))
+         True'''
       raw = tker.tokenize_all({ f: getattr(self, f) for f in fields })
       self.tokens = []
       for (field, token) in raw:
          if (unify):
             self.tokens.append(token)
+         elif (tker.hashed):
+            self.tokens.append(tok.base.hash_combine(
+               tok.base.hash_token(field), token))
          else:
             self.tokens.append(field + ' ' + token)
       return self.tokens
@@ -377,6 +500,58 @@ class Writer(tsv_glue.Writer):
       tsv_glue.Writer.writerow(self, tw.to_list())
 
 
+def read_columns(file_, columns=TSV_COLUMNS):
+   '''Read the preprocessed tweet TSV file file_ and return a dictionary
+      mapping each column name in columns (see TSV_COLUMNS) to its contents.
+      Columns in TSV_ARRAY_DTYPES are converted in bulk to NumPy arrays,
+      with missing coordinates as NaN; the others are lists of strings, with
+      empty fields as None. No Tweet objects are made. E.g.:
+
+      >>> import os
+      >>> import tempfile
+      >>> (fd, filename) = tempfile.mkstemp()
+      >>> w = Writer(fd, clobber=True)
+      >>> w.writerow(from_json(T_TW_JSON_CO))
+      >>> w.writerow(T_TW_SIMPLE)
+      >>> w.close()
+      >>> cols = read_columns(filename)
+      >>> cols['id'].tolist()
+      [186339941163339776, -1]
+      >>> str(cols['created_at'][0])
+      '2012-04-01T06:31:18'
+      >>> cols['lon'].tolist()
+      [16.37778864, nan]
+      >>> cols['geom_src']
+      ['co', None]
+      >>> sorted(read_columns(filename, ('text', 'lat')).keys())
+      ['lat', 'text']
+      >>> [(t.id, t.day, t.coords) for t in Reader(filename)]
+      [(186339941163339776, '2012-04-01', (16.37778864, 48.24424304)), (-1, ...)]
+      >>> os.unlink(filename)'''
+   idxs = [TSV_COLUMNS.index(c) for c in columns]
+   with io.open(file_, encoding='utf8') as fp:
+      rows = [line.rstrip('\n').split('\t') for line in fp]
+   if (len(rows) == 0):
+      cols = [()] * len(TSV_COLUMNS)
+   else:
+      cols = list(zip(*rows))
+   result = dict()
+   for (name, i) in zip(columns, idxs):
+      col = cols[i]
+      dtype = TSV_ARRAY_DTYPES.get(name)
+      if (dtype is None):
+         result[name] = [(v if v != '' else None) for v in col]
+      elif (name == 'created_at'):
+         # drop the UTC offset, which NumPy doesn't handle
+         result[name] = np.array([v[:19] for v in col], dtype=dtype)
+      elif (name in ('lon', 'lat')):
+         result[name] = np.array([(v if v != '' else 'nan') for v in col],
+                                 dtype=dtype)
+      else:
+         result[name] = np.array(col, dtype=dtype)
+   return result
+
+
 # some test data
 T_TW_SIMPLE = Tweet.from_dict({ 'tweet_id':          -1,
                                 'created_at':        datetime.now(),
@@ -405,7 +580,44 @@ datetime.datetime(2012, 4, 1, 6, 31, 18, tzinfo=<UTC>)
 '2012-04-01'
 >>> a == Tweet.from_list(a.to_list())
 True
+>>> b = Tweet.from_list(a.to_list())
+>>> (b.day, b._created_at)
+('2012-04-01', None)
+>>> b.to_list() == a.to_list()
+True
+>>> b.created_at
+datetime.datetime(2012, 4, 1, 6, 31, 18, tzinfo=<UTC>)
+>>> a == Tweet.from_list(a.to_list() + ['extra column'])
+True
+>>> c = Tweet.from_list(['1', 'not a time'] + [None] * 9)
+>>> c.created_at
+Traceback (most recent call last):
+  ...
+ValueError: time data 'not a time' does not match ...
+>>> c.to_list()
+Traceback (most recent call last):
+  ...
+ValueError: time data 'not a time' does not match ...
+>>> c = Tweet.from_list(['1', '2012-04-01 06:31:18+00:00'] + [None] * 9)
+>>> c.to_list()[1]
+'2012-04-01T06:31:18+00:00'
+>>> c = Tweet.from_list(['1', '2012-04-01T06:31:18Z'] + [None] * 9)
+>>> c.to_list()
+Traceback (most recent call last):
+  ...
+ValueError: time data '2012-04-01T06:31:18Z' does not match ...
 >>> a == Tweet.from_dict(a.to_dict())
 True
 
+# Extract only some fields; the geotag becomes a Point only when needed.
+>>> a = from_json(T_TW_JSON_CO, fields={'id', 'text', 'geom'})
+>>> (a.id, a.text, a.user_lang, a.created_at)
+(186339941163339776, 'Guantes, bufanda, tenis y chamarra :) #Viena', None, None)
+>>> a.coords
+(16.37778864, 48.24424304)
+>>> a._geom is None
+True
+>>> a.geom.coords
+(16.37778864, 48.24424304)
+
 ''')
@@ -0,0 +1,283 @@
+'''Columnar, memory-mapped store of preprocessed tweets.
+
+   The daily ``.tsv`` files must be read and converted in full, even by
+   consumers that want only a couple of columns, and conversion of
+   timestamps and coordinates dominates their reading time. This module
+   stores the same tweets as one directory per day with one or two binary
+   files per column, each memory-mapped when read:
+
+     id                    int64
+     created_at            int64 seconds since the Unix epoch (UTC)
+     lon, lat              float32 (NaN if no geotag); note that float32 is
+                           precise to roughly a meter
+     text, user_screen_name, user_description
+                           length-prefixed UTF-8: COL.lens (int32, -1 for
+                           None) and the text, concatenated, in COL.bytes
+     user_lang, user_location, user_time_zone, geom_src
+                           dictionary-encoded: COL.codes (uint32, 0 for
+                           None) indexing COL.dict.lens and COL.dict.bytes,
+                           encoded like the text columns
+
+   :class:`Reader` reads only the columns asked for (*projection*), and
+   filters on creation time and presence of a geotag using only those
+   columns before reading anything else (*predicate pushdown*). For example:
+
+   >>> import datetime
+   >>> import tempfile
+   >>> import pytz
+   >>> tmp = tempfile.mkdtemp()
+   >>> a = tweet.from_json(tweet.T_TW_JSON_CO)
+   >>> b = tweet.Tweet.from_list(['1', '2012-04-01T07:00:00+00:00', 'a b',
+   ...                            None, 'desc', 'en', 'NYC', None,
+   ...                            None, None, None])
+   >>> w = Writer(tmp + '/2012-04-01')
+   >>> w.writerow(a)
+   >>> w.writerow(b)
+   >>> w.close()
+   >>> r = Reader(tmp + '/2012-04-01')
+   >>> len(r)
+   2
+   >>> [t.text for t in r]
+   ['Guantes, bufanda, tenis y chamarra :) #Viena', 'a b']
+   >>> c = list(r)[1]
+   >>> c == b
+   True
+   >>> (c.created_at, c.user_lang, c.user_screen_name)
+   (datetime.datetime(2012, 4, 1, 7, 0, tzinfo=<UTC>), 'en', None)
+   >>> r = Reader(tmp + '/2012-04-01', columns=('text', 'geom'),
+   ...            geotagged=True)
+   >>> [(t.text, t.coords, t.user_lang) for t in r]
+   [('Guantes, bufanda, tenis y chamarra :) #Viena', (16.377788543701172, 48.24424362182617), None)]
+   >>> start = datetime.datetime(2012, 4, 1, 6, 45, tzinfo=pytz.utc)
+   >>> r = Reader(tmp + '/2012-04-01', columns=('id',), start=start)
+   >>> r.columns()['id'].tolist()
+   [1]
+   >>> Reader(tmp + '/2012-04-01', columns=('foo',))
+   Traceback (most recent call last):
+     ...
+   ValueError: unknown column: foo'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import datetime
+import io
+import os
+import shutil
+
+import numpy as np
+import pytz
+
+import testable
+import tweet
+
+
+# Columns, named after Tweet attributes. geom is stored as lon and lat.
+COLUMNS = ('id',
+           'created_at',
+           'text',
+           'user_screen_name',
+           'user_description',
+           'user_lang',
+           'user_location',
+           'user_time_zone',
+           'geom',
+           'geom_src')
+TEXT_COLUMNS = ('text', 'user_screen_name', 'user_description')
+DICT_COLUMNS = ('user_lang', 'user_location', 'user_time_zone', 'geom_src')
+
+# Number of rows the Writer buffers before writing.
+WRITE_BUFSIZE = 65536
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+class Reader(object):
+
+   '''Read the store in directory dir_. Only the given columns (default all)
+      are read. Rows are selected by creation time (start inclusive, end
+      exclusive; aware datetimes) and, if geotagged is not None, by whether
+      or not they have a geotag. Iterating yields Tweet objects with the
+      columns not read set to None; columns() returns the columns in bulk.'''
+
+   def __init__(self, dir_, columns=None, start=None, end=None,
+                geotagged=None):
+      self.dir_ = dir_
+      self.cols = COLUMNS if (columns is None) else tuple(columns)
+      for c in self.cols:
+         if (c not in COLUMNS):
+            raise ValueError('unknown column: %s' % (c))
+      mask = None
+      if (start is not None or end is not None):
+         created_at = map_(dir_, 'created_at', np.int64)
+         mask = np.ones(len(created_at), dtype=bool)
+         if (start is not None):
+            mask &= created_at >= epoch_seconds(start)
+         if (end is not None):
+            mask &= created_at < epoch_seconds(end)
+      if (geotagged is not None):
+         has_geo = ~np.isnan(map_(dir_, 'lon', np.float32))
+         if (not geotagged):
+            has_geo = ~has_geo
+         mask = has_geo if (mask is None) else (mask & has_geo)
+      if (mask is None):
+         self.rows = np.arange(os.path.getsize(dir_ + '/id') // 8)
+      else:
+         self.rows = np.flatnonzero(mask)
+
+   def __iter__(self):
+      cols = self.columns()
+      if ('created_at' in cols):
+         cols['created_at'] = [datetime.datetime.fromtimestamp(t, pytz.utc)
+                               for t in cols['created_at'].astype(np.int64)
+                                                          .tolist()]
+      if ('geom' in self.cols):
+         cols['geom'] = [geo_or_none(lon, lat) for (lon, lat)
+                         in zip(cols.pop('lon').tolist(),
+                                cols.pop('lat').tolist())]
+      if ('id' in cols):
+         cols['id'] = cols['id'].tolist()
+      missing = [c for c in COLUMNS if c not in self.cols]
+      for i in range(len(self.rows)):
+         tw = tweet.Tweet()
+         for (c, values) in cols.items():
+            if (c == 'geom'):
+               tw.coords_set(*values[i])
+            else:
+               setattr(tw, c, values[i])
+         for c in missing:
+            setattr(tw, c, None)
+         yield tw
+
+   def __len__(self):
+      return len(self.rows)
+
+   def columns(self):
+      '''Return a dictionary mapping each column read to its values in the
+         selected rows, like tweet.read_columns(): id, created_at (as
+         datetime64[s]), lon and lat are arrays, and the rest are lists.'''
+      result = dict()
+      for c in self.cols:
+         if (c == 'created_at'):
+            result[c] = (map_(self.dir_, c, np.int64)[self.rows]
+                         .astype('datetime64[s]'))
+         elif (c == 'geom'):
+            for d in ('lon', 'lat'):
+               result[d] = np.array(map_(self.dir_, d, np.float32)[self.rows])
+         elif (c == 'id'):
+            result[c] = np.array(map_(self.dir_, c, np.int64)[self.rows])
+         elif (c in TEXT_COLUMNS):
+            result[c] = texts_read(self.dir_, c, self.rows)
+         else:
+            values = [None] + texts_read(self.dir_, c + '.dict')
+            codes = map_(self.dir_, c + '.codes', np.uint32)[self.rows]
+            result[c] = [values[i] for i in codes.tolist()]
+      return result
+
+
+class Writer(object):
+
+   '''Write tweets to a store in directory dir_, mirroring tweet.Writer. As
+      with ngram_store.Writer, the store is assembled in dir_.tmp and moved
+      into place by close(), replacing any existing store.'''
+
+   def __init__(self, dir_):
+      self.dir_ = dir_
+      self.tmp = dir_ + '.tmp'
+      shutil.rmtree(self.tmp, ignore_errors=True)
+      os.makedirs(self.tmp)
+      names = (['id', 'created_at', 'lon', 'lat']
+               + [c + '.codes' for c in DICT_COLUMNS]
+               + [c + s for c in TEXT_COLUMNS for s in ('.lens', '.bytes')])
+      self.fps = { n: io.open('%s/%s' % (self.tmp, n), 'wb') for n in names }
+      self.dicts = { c: dict() for c in DICT_COLUMNS }
+      self.buf = list()
+
+   def close(self):
+      self.flush()
+      for fp in self.fps.values():
+         fp.close()
+      for (c, codes) in self.dicts.items():
+         values = sorted(codes, key=codes.get)
+         with io.open('%s/%s.dict.lens' % (self.tmp, c), 'wb') as lens_fp, \
+              io.open('%s/%s.dict.bytes' % (self.tmp, c), 'wb') as bytes_fp:
+            texts_write(lens_fp, bytes_fp, values)
+      shutil.rmtree(self.dir_, ignore_errors=True)
+      os.rename(self.tmp, self.dir_)
+
+   def flush(self):
+      if (len(self.buf) == 0):
+         return
+      cols = list(zip(*self.buf))
+      for (name, col, dtype) in (('id', cols[0], np.int64),
+                                 ('created_at', cols[1], np.int64),
+                                 ('lon', cols[2], np.float32),
+                                 ('lat', cols[3], np.float32)):
+         self.fps[name].write(np.array(col, dtype=dtype).tobytes())
+      for (c, col) in zip(DICT_COLUMNS, cols[4:8]):
+         codes = self.dicts[c]
+         self.fps[c + '.codes'].write(
+            np.array([0 if (v is None) else codes.setdefault(v, len(codes) + 1)
+                      for v in col], dtype=np.uint32).tobytes())
+      for (c, col) in zip(TEXT_COLUMNS, cols[8:]):
+         texts_write(self.fps[c + '.lens'], self.fps[c + '.bytes'], col)
+      self.buf = list()
+
+   def writerow(self, tw):
+      (lon, lat) = tw.coords or (np.nan, np.nan)
+      self.buf.append((tw.id, epoch_seconds(tw.created_at), lon, lat,
+                       tw.user_lang, tw.user_location, tw.user_time_zone,
+                       tw.geom_src, tw.text, tw.user_screen_name,
+                       tw.user_description))
+      if (len(self.buf) >= WRITE_BUFSIZE):
+         self.flush()
+
+
+def epoch_seconds(dt):
+   '''Return aware datetime dt as whole seconds since the Unix epoch. E.g.:
+
+      >>> epoch_seconds(datetime.datetime(1970, 1, 2, tzinfo=pytz.utc))
+      86400'''
+   return int((dt - EPOCH).total_seconds())
+
+def from_tsv(filename, dir_):
+   'Convert the preprocessed tweet TSV file filename to a store in dir_.'
+   w = Writer(dir_)
+   for tw in tweet.Reader(filename):
+      w.writerow(tw)
+   w.close()
+
+def geo_or_none(lon, lat):
+   if (lon != lon):  # NaN
+      return (None, None)
+   return (float(lon), float(lat))
+
+def map_(dir_, name, dtype):
+   'Return file name in directory dir_ memory-mapped as an array of dtype.'
+   path = '%s/%s' % (dir_, name)
+   if (os.path.getsize(path) == 0):
+      return np.zeros(0, dtype=dtype)  # can't mmap an empty file
+   return np.memmap(path, dtype=dtype, mode='r')
+
+def texts_read(dir_, name, rows=None):
+   '''Return a list of the strings (or None) in rows (default all) of the
+      length-prefixed text column name.'''
+   lens = np.array(map_(dir_, name + '.lens', np.int32), dtype=np.int64)
+   ends = np.cumsum(np.maximum(lens, 0))
+   starts = ends - np.maximum(lens, 0)
+   if (rows is not None):
+      (lens, starts, ends) = (lens[rows], starts[rows], ends[rows])
+   bytes_ = map_(dir_, name + '.bytes', np.uint8)
+   return [(None if (l < 0) else bytes(bytes_[s:e]).decode('utf8'))
+           for (l, s, e) in zip(lens.tolist(), starts.tolist(), ends.tolist())]
+
+def texts_write(lens_fp, bytes_fp, texts):
+   'Append texts (strings or None) to a length-prefixed text column.'
+   encoded = [(None if (t is None) else t.encode('utf8')) for t in texts]
+   lens_fp.write(np.array([(-1 if (e is None) else len(e)) for e in encoded],
+                          dtype=np.int32).tobytes())
+   bytes_fp.write(b''.join(e for e in encoded if e is not None))
+
+
+# Test-Depends: geo
+testable.register('')
@@ -5,6 +5,8 @@
 
 from unicodedata import *
 
+import testable
+
 script_data = {
 "names":['Common', 'Latin', 'Greek', 'Cyrillic', 'Armenian', 'Hebrew', 'Arabic',
 'Syriac', 'Thaana', 'Devanagari', 'Bengali', 'Gurmukhi', 'Gujarati', 'Oriya',
@@ -557,22 +559,77 @@ script_data = {
 (0xe0020,0xe007f,0,13), (0xe0100,0xe01ef,40,23)
 ]}
 
+# Two-level lookup table mapping code point to (script, category), built
+# lazily from script_data['idx'] by _tables(). Each value packs the script
+# index and category index as (script << 5) | category; code points not
+# listed in idx get script 'Unknown' and category 'Zzzz'. The code space is
+# divided into pages of 256 code points; _pages maps page number to a row of
+# _blocks, and identical pages (e.g., all the unassigned ones) share a row.
+_PAGE_BITS = 8
+_CAT_BITS = 5
+_pages = None
+_blocks = None
+_names = None
+_cats = None
+
+def _tables():
+    global _pages, _blocks, _names, _cats
+    if _pages is None:
+        import numpy as np
+        names = script_data['names'] + ['Unknown']
+        cats = script_data['cats'] + ['Zzzz']
+        assert len(cats) <= 1 << _CAT_BITS
+        dense = np.empty(0x110000, dtype=np.uint16)
+        dense[:] = (len(names) - 1) << _CAT_BITS | (len(cats) - 1)
+        for (a, b, s, c) in script_data['idx']:
+            dense[a:b+1] = s << _CAT_BITS | c
+        (blocks, pages) = np.unique(dense.reshape(-1, 1 << _PAGE_BITS),
+                                    axis=0, return_inverse=True)
+        _blocks = blocks
+        _pages = pages.reshape(-1).astype(np.uint16)
+        _names = names
+        _cats = cats
+    return (_pages, _blocks)
+
 def script_cat(chr):
-    """ For the unicode character chr return a tuple (Scriptname, Category). """
-    l = 0
-    r = len(script_data['idx']) - 1
+    """ For the unicode character chr return a tuple (Scriptname, Category).
+
+        >>> script_cat('a')
+        ('Latin', 'L')
+        >>> script_cat('\u3042')
+        ('Hiragana', 'Lo')
+        >>> script_cat('\U0010fffd')
+        ('Unknown', 'Zzzz')
+        """
+    (pages, blocks) = _tables()
     c = ord(chr)
-    while r >= l:
-        m = (l + r) >> 1
-        if c < script_data['idx'][m][0]:
-            r = m - 1
-        elif c > script_data['idx'][m][1]:
-            l = m + 1
-        else:
-            return (
-                script_data['names'][script_data['idx'][m][2]], 
-                script_data['cats'][script_data['idx'][m][3]])
-    return 'Unknown', 'Zzzz'
+    v = int(blocks[pages[c >> _PAGE_BITS], c & ((1 << _PAGE_BITS) - 1)])
+    return (_names[v >> _CAT_BITS], _cats[v & ((1 << _CAT_BITS) - 1)])
+
+def script_runs(text):
+    """ Split text into maximal runs of characters with the same script and
+        category, returning a list of (Scriptname, Category, run) tuples.
+        The lookup is vectorized over the whole string, so this is much
+        faster than calling script_cat() on each character.
+
+        >>> script_runs('Hi, \u3042\u3044!')
+        [('Latin', 'L', 'Hi'), ('Common', 'Po', ','), ('Common', 'Zs', ' '), ('Hiragana', 'Lo', '\u3042\u3044'), ('Common', 'Po', '!')]
+        >>> script_runs('')
+        []
+        """
+    import numpy as np
+    if not text:
+        return []
+    (pages, blocks) = _tables()
+    cps = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'),
+                        dtype='<u4')
+    vals = blocks[pages[cps >> _PAGE_BITS], cps & ((1 << _PAGE_BITS) - 1)]
+    starts = np.flatnonzero(vals[1:] != vals[:-1]) + 1
+    ends = np.append(starts, len(text)).tolist()
+    starts = [0] + starts.tolist()
+    mask = (1 << _CAT_BITS) - 1
+    return [(_names[v >> _CAT_BITS], _cats[v & mask], text[s:e])
+            for (v, s, e) in zip(vals[starts].tolist(), starts, ends)]
 
 def script(chr):
     a, _ = script_cat(chr)
@@ -608,3 +665,6 @@ def _compile_scripts_txt():
         '\n'.join(textwrap.wrap(repr(names), 80)),
         '\n'.join(textwrap.wrap(repr(cats), 80)),
         '\n'.join(textwrap.wrap(', '.join('(0x%x,0x%x,%d,%d)' % c for c in idx), 80))))        
+
+
+testable.register('')
@@ -18,6 +18,9 @@
 #include <stdlib.h>
 #include <string.h>
 #include <sys/stat.h>
+#include <unistd.h>
+
+#include <zlib.h>
 
 
 /** Constants **/
@@ -29,35 +32,79 @@
    FIXME: this parameter has not been tuned experimentally. */
 #define OUTPUT_BUFSIZE 4194304
 
+/* zlib mode strings for output files: level 1 (fastest) compression with -z,
+   otherwise uncompressed ("transparent") writing. */
+#define MODE_COMPRESS "wb1"
+#define MODE_PLAIN "wbT"
+
+
+/** Types **/
+
+/* One key of a partition map (see lib/qr/skew.py). The map is an
+   open-addressing hash table of these, using the same hash as for
+   partitioning; empty slots have key NULL. */
+typedef struct {
+   char * key;
+   size_t len;
+   unsigned int hash;
+   int partition;
+} pmap_entry;
+
 
 /** Prototypes **/
 
 void fatal(char * msg, ...);
 unsigned int hash(char * str, char * end);
-void output_close(FILE * out[], int ct);
-FILE ** output_open(char * basename, int ct);
-void split(FILE ** out, int output_ct);
+void output_close(gzFile out[], int ct);
+gzFile * output_open(char * basename, int ct, char * mode);
+int pmap_lookup(char * key, char * end, unsigned int h);
+void pmap_read(char * filename, int output_ct);
+void split(gzFile * out, int output_ct);
 void usage();
 
 
+/** Globals **/
+
+/* Partition map, or NULL if none; pmap_mask is its size minus one. */
+pmap_entry * pmap = NULL;
+size_t pmap_mask;
+
+
 /** Main **/
 
 int main(int argc, char * argv[])
 {
    int output_ct;
-   FILE ** out;
+   gzFile * out;
+   char * mode = MODE_PLAIN;
+   char * pmap_filename = NULL;
+   int opt;
 
    // parse args
-   if (argc != 3)
+   while ((opt = getopt(argc, argv, "m:z")) != -1) {
+      switch (opt) {
+      case 'm':
+         pmap_filename = optarg;
+         break;
+      case 'z':
+         mode = MODE_COMPRESS;
+         break;
+      default:
+         usage();
+      }
+   }
+   if (argc - optind != 2)
       usage();
-   output_ct = atoi(argv[1]);
+   output_ct = atoi(argv[optind]);
    if (output_ct < 1)
       fatal("invalid number of output files: %d", output_ct);
-   if (strlen(argv[2]) == 0)
+   if (strlen(argv[optind + 1]) == 0)
       fatal("length of BASENAME cannot be 0");
 
    // do the work
-   out = output_open(argv[2], output_ct);
+   if (pmap_filename)
+      pmap_read(pmap_filename, output_ct);
+   out = output_open(argv[optind + 1], output_ct, mode);
    split(out, output_ct);
    output_close(out, output_ct);
 
@@ -98,20 +145,20 @@ unsigned int hash (char * str, char * end)
 }
 
 /* Close the files in the given array, and free() the array. */
-void output_close(FILE * out[], int ct)
+void output_close(gzFile out[], int ct)
 {
    for (int i = 0; i < ct; i++)
-      if (fclose(out[i]))
-         fatal("error closing file: %s", errno);
+      if (gzclose(out[i]) != Z_OK)
+         fatal("error closing file: %s", strerror(errno));
    free(out);
 }
 
-/* Open the appropriate output files and return an array of file pointers. */
-FILE ** output_open(char * basename, int ct)
+/* Open the appropriate output files, with zlib mode string mode, and return
+   an array of file pointers. */
+gzFile * output_open(char * basename, int ct, char * mode)
 {
-   FILE ** out = calloc(ct, sizeof(FILE *));
+   gzFile * out = calloc(ct, sizeof(gzFile));
    char * filename;
-   char * buf;
 
    /* Create directory, if needed. We ignore EEXIST because we want to keep
       going if it's a directory that already exists. */
@@ -124,28 +171,90 @@ FILE ** output_open(char * basename, int ct)
    for (int i = 0; i < ct; i++) {
       if (asprintf(&filename, "%s/%d", basename, i) == -1)
          fatal("asprintf() failed");
-      out[i] = fopen(filename, "wb");
+      out[i] = gzopen(filename, mode);
       if (!out[i])
          fatal("can't open %s: %s", filename, strerror(errno));
-      buf = malloc(OUTPUT_BUFSIZE);
-      if (buf == NULL)
-         fatal("malloc() failed");
-      if (setvbuf(out[i], buf, _IOFBF, OUTPUT_BUFSIZE))
-         fatal("setvbuf() failed: %s", strerror(errno));
+      if (gzbuffer(out[i], OUTPUT_BUFSIZE))
+         fatal("gzbuffer() failed");
       free(filename);
    }
 
    return out;
 }
 
+/* Return the partition of the key from key to end (exclusive), which has
+   hash h, in the partition map, or -1 if it's not there. */
+int pmap_lookup(char * key, char * end, unsigned int h)
+{
+   size_t len = end - key;
+
+   for (size_t i = h & pmap_mask; pmap[i].key; i = (i + 1) & pmap_mask)
+      if (pmap[i].hash == h && pmap[i].len == len
+          && !memcmp(pmap[i].key, key, len))
+         return pmap[i].partition;
+
+   return -1;
+}
+
+/* Read the partition map in file filename into the global pmap. Each line is
+   a key, a tab, and a partition number less than output_ct. */
+void pmap_read(char * filename, int output_ct)
+{
+   FILE * fp;
+   char * line = NULL;
+   size_t linebuf_sz = 0;
+   ssize_t read_sz;
+   char * tab;
+   size_t ct = 0, size = 1;
+   pmap_entry * entries = NULL;
+
+   fp = fopen(filename, "r");
+   if (!fp)
+      fatal("can't open %s: %s", filename, strerror(errno));
+   while ((read_sz = getline(&line, &linebuf_sz, fp)) != -1) {
+      if (line[read_sz - 1] == '\n')
+         line[read_sz - 1] = '\0';
+      tab = strchr(line, '\t');
+      if (tab == NULL)
+         fatal("bad partition map line: %s", line);
+      entries = realloc(entries, (ct + 1) * sizeof(pmap_entry));
+      entries[ct].len = tab - line;
+      entries[ct].key = strndup(line, entries[ct].len);
+      entries[ct].hash = hash(line, tab);
+      entries[ct].partition = atoi(tab + 1);
+      if (entries[ct].partition < 0 || entries[ct].partition >= output_ct)
+         fatal("partition out of range in partition map: %s", line);
+      ct++;
+   }
+   if (!feof(fp))
+      fatal("error reading %s: %s", filename, strerror(errno));
+   fclose(fp);
+   free(line);
+
+   // Build the table, at most half full.
+   while (size < 2 * ct)
+      size *= 2;
+   pmap = calloc(size, sizeof(pmap_entry));
+   pmap_mask = size - 1;
+   for (size_t j = 0; j < ct; j++) {
+      size_t i = entries[j].hash & pmap_mask;
+      while (pmap[i].key)
+         i = (i + 1) & pmap_mask;
+      pmap[i] = entries[j];
+   }
+   free(entries);
+}
+
 /* Do the actual splitting of stdin. out is an array of open file descriptors,
    and output_ct is its length. */
-void split(FILE ** out, int output_ct)
+void split(gzFile * out, int output_ct)
 {
    char * line = NULL;
    size_t linebuf_sz = 0;
    ssize_t read_sz;
    char * end;
+   unsigned int h;
+   int i;
 
    while ((read_sz = getline(&line, &linebuf_sz, stdin)) != -1) {
       /* Set end to the first tab if one exists, else the trailing newline. If
@@ -154,7 +263,11 @@ void split(FILE ** out, int output_ct)
       end = strchr(line, '\t');
       if (end == NULL)
          end = (line + read_sz - 1);
-      fputs(line, out[hash(line, end) % output_ct]);
+      h = hash(line, end);
+      if (!pmap || (i = pmap_lookup(line, end, h)) == -1)
+         i = h % output_ct;
+      if (gzwrite(out[i], line, read_sz) != read_sz)
+         fatal("error writing output");
    }
 
    if (!feof(stdin))
@@ -170,11 +283,14 @@ void usage()
 {
    fatal(
       /* If we were less lazy, we would use the executable name in argv[0]. */
-      "usage: hashsplit N BASENAME\n"
+      "usage: hashsplit [-z] [-m FILE] N BASENAME\n"
       "\n"
       "Split standard input containing a stream of key/value lines separated\n"
       "by a single tab into N output files named BASENAME.i according to the\n"
       "hash values of the keys. The value may be absent, either with or\n"
       "without a tab following the key. Keys and values may contain any bytes\n"
-      "except zero, tab, and newline.");
+      "except zero, tab, and newline. With -z, compress the output files with\n"
+      "gzip (fastest setting). With -m, keys listed in partition map FILE\n"
+      "(lines of key, tab, output file number) go to the given output file\n"
+      "instead.");
 }